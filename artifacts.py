@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Columnar cache of the processed frames
+#
+# The frames coming out of data.versioned_frames only depend on the raw feeds
+# and on the processing code, so they are stored as feather files under
+# config.artifact_dir/<version>/, where version is a hash of the raw source
+# bytes plus data.PIPELINE_VERSION. Same source, same version: the frames are
+# read back instead of being rebuilt. Next to them, tables-<n>.pkl holds the
+# tables precompute.py works out from the frames (ETA tables, heatmap cube,
+# rankings), n being the precompute.TABLES_VERSION of the code that built them,
+# and figures-<n>.pkl the json of every figure of the page (figures.render_all),
+# n being figures.FIGURES_VERSION.
+#
+# The directory is shared by every server process on the host. The one holding
+# the publisher lock refreshes the feeds, builds the frames and publishes their
+# version in config.artifact_dir/CURRENT; the others only read CURRENT and map
+# the files of that version. The files are uncompressed so they can be memory
+# mapped, numeric columns without missing values are then read straight out of
+# the shared page cache.
+
+import os
+import fcntl
+import pickle
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import pandas as pd
+import pyarrow.feather as feather
+import config
+import store
+
+FRAME_NAMES = ['df', 'overall_state_df', 'overall_ag_df', 'sag_df', 'milestone_df']
+INDEX_COL = '__index__'
+TABLES_FILE = 'tables-{}.pkl'
+FIGURES_FILE = 'figures-{}.pkl'
+
+
+def source_hash(names=None):
+    h = hashlib.sha256()
+    for name in sorted(names or config.feeds):
+        with open(store.ensure_feed(name), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    for path in config.static_sources:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def data_version(pipeline_version):
+    h = hashlib.sha256()
+    h.update(source_hash().encode())
+    h.update(str(pipeline_version).encode())
+    return h.hexdigest()[:16]
+
+
+def version_dir(version):
+    return os.path.join(config.artifact_dir, version)
+
+
+def save_frames(version, frames):
+    os.makedirs(config.artifact_dir, exist_ok=True)
+    # build the whole version in a temp dir and rename it into place,
+    # a reader either sees all the frames or none of them
+    tmp = tempfile.mkdtemp(dir=config.artifact_dir, prefix='.tmp-')
+    for name, f in zip(FRAME_NAMES, frames):
+        # feather wants a default index, keep the real one as a column
+        feather.write_feather(f.rename_axis(INDEX_COL).reset_index(),
+                              os.path.join(tmp, name + '.feather'), compression='uncompressed')
+    try:
+        os.rename(tmp, version_dir(version))
+    except OSError:
+        # someone else got there first, same content anyway
+        shutil.rmtree(tmp, ignore_errors=True)
+    prune()
+
+
+def load_frames(version):
+    path = version_dir(version)
+    if not os.path.isdir(path):
+        return None
+
+    frames = []
+    for name in FRAME_NAMES:
+        table = feather.read_table(os.path.join(path, name + '.feather'), memory_map=True)
+        # one block per column keeps the mapped columns as they are, and the
+        # index is moved over by hand as set_index would copy the whole frame
+        f = table.to_pandas(split_blocks=True)
+        f.index = pd.Index(f.pop(INDEX_COL).to_numpy())
+        frames.append(f)
+    return tuple(frames)
+
+
+def extra_path(version, file, code_version):
+    return os.path.join(version_dir(version), file.format(code_version))
+
+
+def save_extra(version, file, code_version, value):
+    # added to a version already saved, so written on its own and renamed into place
+    store.write_file(extra_path(version, file, code_version),
+                     pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_extra(version, file, code_version):
+    # None when the version has none built by this code
+    try:
+        with open(extra_path(version, file, code_version), 'rb') as f:
+            return pickle.load(f)
+    except OSError:
+        return None
+
+
+def save_tables(version, tables_version, tables):
+    save_extra(version, TABLES_FILE, tables_version, tables)
+
+
+def has_tables(version, tables_version):
+    return os.path.exists(extra_path(version, TABLES_FILE, tables_version))
+
+
+def load_tables(version, tables_version):
+    return load_extra(version, TABLES_FILE, tables_version)
+
+
+def save_figures(version, figures_version, rendered):
+    save_extra(version, FIGURES_FILE, figures_version, rendered)
+
+
+def has_figures(version, figures_version):
+    return os.path.exists(extra_path(version, FIGURES_FILE, figures_version))
+
+
+def load_figures(version, figures_version):
+    return load_extra(version, FIGURES_FILE, figures_version)
+
+
+def current_path():
+    return os.path.join(config.artifact_dir, 'CURRENT')
+
+
+def current_version():
+    # version published for every process to serve, None before the first one
+    try:
+        with open(current_path()) as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    return version if os.path.isdir(version_dir(version)) else None
+
+
+def publish(version):
+    store.write_file(current_path(), version.encode())
+
+
+@contextlib.contextmanager
+def publisher(blocking=False):
+    """
+    Lock making this process the one that refreshes and publishes, yields
+    whether it got it. Without blocking, a process finding the lock taken just
+    goes on with what is published
+    """
+    os.makedirs(config.artifact_dir, exist_ok=True)
+    with open(os.path.join(config.artifact_dir, '.lock'), 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def prune():
+    # keep the most recent few versions around, drop the rest. A process still
+    # mapping a dropped version keeps its files until it lets go of them
+    current = current_version()
+    versions = [os.path.join(config.artifact_dir, v) for v in os.listdir(config.artifact_dir)
+                if not v.startswith('.') and v != current
+                and os.path.isdir(os.path.join(config.artifact_dir, v))]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    for v in versions[config.artifact_keep - 1:]:
+        shutil.rmtree(v, ignore_errors=True)
@@ -1,7 +1,7 @@
 import plotly.express as px
-import plotly.figure_factory as ff
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
+import plotly.colors as pcolors
 import pandas as pd
 import numpy as np
 from itertools import cycle
@@ -127,6 +127,114 @@ def eta_chart(df, group_col, user, hl=False, annot=False):
     return fig
 
 
+# each dose's share of the day's doses, (column, made from), see dose_frame
+PROP_COLS = [('delta_dose1_prop', 'delta_dose1_mod'), ('delta_dose2_prop', 'delta_dose2_mod'),
+             ('delta_dose12_prop', 'delta_dose12_mod')]
+
+def dose_frame(df, exclude_aus):
+    """
+    df with the columns the dose charts plot added: the PROP_COLS shares of the
+    day and the dose 1 / dose 2 split of each row (dose1_prop, dose2_prop).
+    exclude_aus leaves out the AUS rows, for the charts stacking the states.
+    Built once per frame and shared, read only
+    """
+    def build():
+        d = df[df['state'] != 'AUS'] if exclude_aus else df
+        day = d.groupby('date')[[c for (_, c) in PROP_COLS]].transform('sum')
+        cols = {p: round(100 * d[c] / day[c], 2) for (p, c) in PROP_COLS}
+        cols['dose1_prop'] = round(100 * d['delta_dose1_mod'] / d['delta_dose12_mod'], 2)
+        cols['dose2_prop'] = 100 - cols['dose1_prop']
+        return compare.read_only(d.assign(**cols))
+    return compare.cached(df, ('dose_frame', exclude_aus), build)
+
+def line_labels(df, grouping, x, y):
+    """
+    (group, x, y) of the label at the end of each group's line, from the rows
+    of the latest date. Against dates the labels sit 2 days after the last one.
+    Built once per frame
+    """
+    def build():
+        latest = compare.get_latest(df)
+        by = latest.groupby(grouping, observed=True, sort=False)
+        ys = by[y].max()
+        if x == 'date':
+            xs = [df['date'].max() + datetime.timedelta(days=2)] * len(ys)
+        else:
+            xs = by[x].max() + 1
+        return list(zip(ys.index, xs, ys))
+    return compare.cached(df, ('line_labels', grouping, x, y), build)
+
+def lttb(x, y, n):
+    """
+    Positions of the n points largest-triangle-three-buckets keeps of the line
+    (x, y): the first and the last one, and from each of n - 2 buckets of the
+    points between, the one making the largest triangle with the point kept
+    before it and the average of the next bucket. Below 3 points, the ends
+    """
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][:n])
+    edges = (np.arange(n - 1) * (size - 2) / (n - 2)).astype(int) + 1
+    edges[-1] = size - 1
+    keep = np.empty(n, dtype=int)
+    keep[0] = a = 0
+    for i in range(n - 2):
+        (lo, hi) = (edges[i], edges[i + 1])
+        # average of the next bucket, the last point for the last bucket
+        nxt = slice(hi, edges[i + 2]) if i + 2 < len(edges) else slice(size - 1, size)
+        (cx, cy) = (x[nxt].mean(), y[nxt].mean())
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        keep[i + 1] = a = lo + int(area.argmax())
+    keep[-1] = size - 1
+    return keep
+
+def downsample(fig):
+    """
+    Cap the points of each line of fig at config.chart_max_points with lttb.
+    The runs of points with a value are downsampled each, the gaps between them
+    stay, and so do the first and the latest point. Updates fig and returns it
+    """
+    cap = config.chart_max_points
+    if not cap:
+        return fig
+    for trace in fig.data:
+        # plotly express draws the lines of a big frame as scattergl
+        if trace.type not in ('scatter', 'scattergl') or trace.x is None or len(trace.x) <= cap:
+            continue
+        size = len(trace.x)
+        xs = pd.Series(trace.x)
+        if pd.api.types.is_datetime64_any_dtype(xs):
+            x = xs.values.astype('int64').astype(float)
+        else:
+            x = pd.to_numeric(xs, errors='coerce').to_numpy(float)
+        y = pd.to_numeric(pd.Series(trace.y), errors='coerce').to_numpy(float)
+        valid = np.isfinite(x) & np.isfinite(y)
+        total = valid.sum()
+        if not total:
+            continue
+        # (start, end) of each run of valid points
+        bounds = np.flatnonzero(np.diff(np.concatenate([[0], valid.astype(int), [0]])))
+        runs = list(zip(bounds[::2], bounds[1::2]))
+        # every run keeps its two ends and every gap a point, the rest of the
+        # cap is shared by the runs by their length
+        gaps = len(runs) - (runs[-1][1] == size)
+        spare = max(0, cap - gaps - 2 * len(runs))
+        keep = []
+        for (lo, hi) in runs:
+            n = 2 + spare * (hi - lo) // total
+            keep.extend(lo + lttb(x[lo:hi], y[lo:hi], n))
+            if hi < size:
+                # the point without a value after the run keeps the gap
+                keep.append(hi)
+        keep = np.array(keep, dtype=int)
+        for attr in ['x', 'y', 'customdata', 'hovertext', 'text']:
+            v = trace[attr]
+            if v is not None and not isinstance(v, str) and len(v) == size:
+                trace[attr] = np.asarray(v)[keep]
+    return fig
+
 def line_chart(df, **kwargs):
     """
         col: dataframe's column name
@@ -135,9 +243,6 @@ def line_chart(df, **kwargs):
         grouping: 'state' or 'age_group'
     """
 
-    fig = px.line()
-    ann = []
-    latest_df = compare.get_latest(df)
     grouping=kwargs['color']
 
     if kwargs['opt_aa'] == 'Growth Rate vs Coverage':
@@ -151,13 +256,6 @@ def line_chart(df, **kwargs):
             min_y = min(df[columns].min())
             max_y = max(df[columns].max())
             kwargs['range_y'] = [0 , max_y * 1.1]
-
-        for i in latest_df[grouping].unique():
-            ann.append(
-                    {'x': latest_df[latest_df[grouping] == i][x].max() + 1,
-                    'y': latest_df[latest_df[grouping] == i][y].max(),
-                    'text': i, 'showarrow': False }
-            )
     else:
         x = x_label = 'date'
         y = kwargs['y']
@@ -170,12 +268,7 @@ def line_chart(df, **kwargs):
             max_y = max(df[columns].max())
             kwargs['range_y'] = [0 , max_y * 1.1]
 
-        for i in latest_df[grouping].unique():
-            ann.append(
-                    {'x': df[x].max() + datetime.timedelta(days=2),
-                    'y': latest_df[latest_df[grouping] == i][y].max(),
-                    'text': i, 'showarrow': False }
-            )
+    ann = [{'x': lx, 'y': ly, 'text': g, 'showarrow': False} for (g, lx, ly) in line_labels(df, grouping, x, y)]
 
     if y in ['ma7_vac_rate'] and kwargs['opt_autoscale'] == 'off':
         max_y = df[y].max()
@@ -204,7 +297,7 @@ def line_chart(df, **kwargs):
     # if kwargs['opt_aa'] == "Growth Rate vs Coverage":
     #     disable_hover(fig)
 
-    return fig
+    return downsample(fig)
 
     # annotations labelling
     # add_annot_vrect(fig, latest_df[[grouping, kwargs['y']]])
@@ -343,15 +436,180 @@ def add_custom_age_groups(l_df, total_12plus_df):
 
     return l_df
 
-def heatmap_delta_data_dynamic(df, opt_ag, opt_aj, opt_as, headline_only=False):
-    a = compare.get_latest(df)
+# The heatmap tables of every date, for the time slider.
+# Arrays are [date x heatmap row x state], rows being the labels heatmap_data
+# shows (age groups, tot 12+/16+/pop and the empty row) and states in
+# config.states_rank order; present marks the cells heatmap_data has a row for
+HEATMAP_TOTALS = ['tot 12+', 'tot 16+', 'tot pop']
+GAP_STATES = ['ACT', 'NSW', 'VIC', 'TAS', 'SA', 'NT', 'QLD', 'WA']
+DELTA_PP = [['delta_dose1pp', 'delta_dose1', 2],
+            ['delta_dose2pp', 'delta_dose2', 2],
+            ['delta_dose1pp_7d', 'delta_dose1_7d', 1],
+            ['delta_dose2pp_7d', 'delta_dose2_7d', 1],
+            ['delta_dose1pp_30d', 'delta_dose1_30d', 1],
+            ['delta_dose2pp_30d', 'delta_dose2_30d', 1]]
+
+def heatmap_cube(sag_df, overall_state_df):
+    """
+    Coverage, gap and delta heatmap tables for every date, built once per data
+    version. Moving the time slider then only reads one date out of it
+    """
+    cube = compare.cached(sag_df, 'heatmap_cube', lambda: build_heatmap_cube(sag_df, overall_state_df))
+    if cube['overall_state_df'] is not overall_state_df:
+        cube = build_heatmap_cube(sag_df, overall_state_df)
+    return cube
 
-    a['delta_dose1pp']=round(a['delta_dose1']/a['abspop_jun2020'] * 100, 2)
-    a['delta_dose2pp']=round(a['delta_dose2']/a['abspop_jun2020'] * 100, 2)
-    a['delta_dose1pp_7d']=round(a['delta_dose1_7d']/a['abspop_jun2020'] * 100, 1)
-    a['delta_dose2pp_7d']=round(a['delta_dose2_7d']/a['abspop_jun2020'] * 100, 1)
-    a['delta_dose1pp_30d']=round(a['delta_dose1_30d']/a['abspop_jun2020'] * 100, 1)
-    a['delta_dose2pp_30d']=round(a['delta_dose2_30d']/a['abspop_jun2020'] * 100, 1)
+def build_heatmap_cube(sag_df, overall_state_df):
+    twelve_plus_df = overall_state_df[overall_state_df['age_group'] == '12_or_above']
+    sixteen_plus_df = overall_state_df[overall_state_df['age_group'] == '16_or_above']
+
+    # total population rows from the 12+ dose counts, same as add_custom_age_groups
+    state_pop = pd.read_csv('state_total_pop.csv')
+    state_pop['state'] = pd.Categorical(state_pop['state'], config.states_rank)
+    tot_df = twelve_plus_df.drop(columns=['abspop_jun2020']).merge(state_pop, on='state')
+    tot_df['dose1_pct'] = round(tot_df['dose1_cnt']/tot_df['abspop_jun2020'] * 100, 2)
+    tot_df['dose2_pct'] = round(tot_df['dose2_cnt']/tot_df['abspop_jun2020'] * 100, 2)
+
+    sag_df = sag_df[sag_df['age_group'].notna()]
+    ag = sag_df['age_group'].astype(str).to_numpy()
+    parts = [(twelve_plus_df, 'tot 12+'), (sixteen_plus_df, 'tot 16+'), (tot_df, 'tot pop'),
+             (tot_df.assign(dose1_pct=0.0, dose2_pct=0.0), 'empty row'), (sag_df, ag)]
+    # heatmap_data sorts the labels as strings
+    rows = np.array(sorted(set(ag) | set(HEATMAP_TOTALS + ['empty row'])), dtype=object)
+    dates = np.unique(np.concatenate([f['date'].to_numpy() for (f, _) in parts]))
+    states = config.states_rank
+
+    shape = (len(dates), len(rows), len(states))
+    cube = {'dates': dates, 'rows': rows, 'overall_state_df': overall_state_df,
+            'present': np.zeros(shape, dtype=bool),
+            'dose1_pct': np.full(shape, np.nan), 'dose2_pct': np.full(shape, np.nan),
+            'delta_present': np.zeros((len(dates), len(states)), dtype=bool),
+            'delta': np.full((len(dates), len(DELTA_PP), len(states)), np.nan)}
+    for (f, label) in parts:
+        di = np.searchsorted(dates, f['date'].to_numpy())
+        ri = np.searchsorted(rows.astype(str), label)
+        si = pd.Categorical(f['state'], states).codes
+        keep = si >= 0
+        (di, si) = (di[keep], si[keep])
+        ri = ri[keep] if np.ndim(ri) else ri
+        cube['present'][di, ri, si] = True
+        for c in ['dose1_pct', 'dose2_pct']:
+            cube[c][di, ri, si] = f[c].to_numpy()[keep]
+
+    # the gap heatmap caps the 16+ and age group coverage at 95
+    cube['capped'] = np.isin(rows, list(set(ag)) + ['tot 16+'])
+
+    di = np.searchsorted(dates, sixteen_plus_df['date'].to_numpy())
+    si = pd.Categorical(sixteen_plus_df['state'], states).codes
+    keep = si >= 0
+    pop = sixteen_plus_df['abspop_jun2020'].to_numpy()[keep]
+    cube['delta_present'][di[keep], si[keep]] = True
+    for (k, (_, c, digits)) in enumerate(DELTA_PP):
+        cube['delta'][di[keep], k, si[keep]] = np.round(sixteen_plus_df[c].to_numpy()[keep]/pop * 100, digits)
+
+    return cube
+
+def cube_index(cube, date):
+    # position of date in the cube, None when the cube has nothing for it
+    if cube is None or date is None:
+        return None
+    d = np.datetime64(pd.Timestamp(date))
+    i = np.searchsorted(cube['dates'], d)
+    if i < len(cube['dates']) and cube['dates'][i] == d:
+        return i
+    return None
+
+def cube_rows(rows, present, values, x):
+    """
+    y labels and z rows of one date, laid out like heatmap_data does:
+    rows in order of the first state having them, then by label, and each
+    row over the states of x that have a value
+    """
+    states = [config.states_rank.index(s) for s in x]
+    ids = np.flatnonzero(present.any(axis=1))
+    ids = ids[np.lexsort((ids, present[ids].argmax(axis=1)))]
+    z = [values[r, states][present[r, states]].tolist() for r in ids]
+    return rows[ids], z
+
+def cube_heatmap_data(cube, i, col='dose1_pct', headline_only=False):
+    present = cube['present'][i]
+    if headline_only:
+        present = present & np.isin(cube['rows'], HEATMAP_TOTALS)[:, None]
+    x = config.states_rank_heatmap
+    y, z = cube_rows(cube['rows'], present, np.round(cube[col][i], 1), x)
+    return x, y, z
+
+def cube_gap_data(cube, i, col='dose1_pct'):
+    rows = cube['rows']
+    present = cube['present'][i].copy()
+    present[:, config.states_rank.index('AUS')] = False
+    with np.errstate(invalid='ignore'):
+        v = np.where(cube['capped'][:, None] & (cube[col][i] >= 94.99), 95, cube[col][i])
+    v[rows == 'empty row'] = np.nan
+
+    # gap to the best state of each row
+    best = np.where(present & ~np.isnan(v), v, -np.inf).max(axis=1, keepdims=True)
+    gap = np.where(best == -np.inf, np.nan, best) - v
+    y, z = cube_rows(rows, present, np.round(gap, 1), GAP_STATES)
+    return GAP_STATES, y, z
+
+def cube_delta_row(cube, i, name):
+    states = [config.states_rank.index(s) for s in config.states_rank_heatmap]
+    k = [c for (c, _, _) in DELTA_PP].index(name)
+    return cube['delta'][i, k, states][cube['delta_present'][i, states]]
+
+def cell_text_colours(colorscale):
+    # text colour reading best on the low and the high end of the colorscale,
+    # black or white, as figure_factory picks them
+    def pick(colour):
+        rgb = pcolors.unlabel_rgb(colour) if 'rgb' in colour else pcolors.hex_to_rgb(colour)
+        return '#000000' if rgb[0] * 0.299 + rgb[1] * 0.587 + rgb[2] * 0.114 > 186 else '#FFFFFF'
+    return pick(colorscale[0][1]), pick(colorscale[-1][1])
+
+def heatmap_traces(z, x, y, colorscale, blank_row=None, **kwargs):
+    """
+    Heatmap of the rows z (a row only has the first len(row) states of x) and
+    one text trace writing the values in the cells, in place of the layout
+    annotation per cell of ff.create_annotated_heatmap. Cells look the same:
+    same text, and the text colour switches at the middle of the z range.
+    The cells of blank_row get no text. kwargs go to the heatmap
+    """
+    heatmap = go.Heatmap(z=z, x=list(x), y=list(y), colorscale=colorscale, showscale=False,
+                         reversescale=False, **kwargs)
+    (low, high) = cell_text_colours(heatmap.colorscale)
+    zmin = kwargs.get('zmin', min([v for row in z for v in row]))
+    zmax = kwargs.get('zmax', max([v for row in z for v in row]))
+    zmid = (zmax + zmin) / 2
+
+    cells = [(x[m], y[n], str(v), low if v < zmid else high)
+             for (n, row) in enumerate(z) if y[n] != blank_row for (m, v) in enumerate(row)]
+    (cx, cy, text, colour) = [list(c) for c in zip(*cells)] if cells else ([], [], [], [])
+    labels = go.Scatter(x=cx, y=cy, text=text, mode='text', textfont=dict(color=colour),
+                        hoverinfo='skip', showlegend=False)
+    return (heatmap, labels)
+
+def annotated_heatmap(z, x, y, colorscale, blank_row=None, **kwargs):
+    # figure of heatmap_traces, with the axes of ff.create_annotated_heatmap and
+    # the first row at the top. The ranges are fixed to the cells, autorange
+    # would pad them for the text trace
+    fig = go.Figure(heatmap_traces(z, x, y, colorscale, blank_row, **kwargs))
+    fig.update_layout(xaxis=dict(ticks="", dtick=1, side="top", gridcolor="rgb(0, 0, 0)",
+                                 range=[-0.5, len(x) - 0.5]),
+                      yaxis=dict(ticks="", dtick=1, ticksuffix="  ", range=[len(y) - 0.5, -0.5]))
+    return fig
+
+def heatmap_delta_data_dynamic(df, opt_ag, opt_aj, opt_as, headline_only=False, cube=None, date=None):
+    # with a heatmap_cube, the 16+ jurisdiction rows of date are read from it
+    ci = cube_index(cube, date) if opt_as == 'Jurisdictions' else None
+    if ci is None:
+        a = compare.get_latest(df)
+
+        a['delta_dose1pp']=round(a['delta_dose1']/a['abspop_jun2020'] * 100, 2)
+        a['delta_dose2pp']=round(a['delta_dose2']/a['abspop_jun2020'] * 100, 2)
+        a['delta_dose1pp_7d']=round(a['delta_dose1_7d']/a['abspop_jun2020'] * 100, 1)
+        a['delta_dose2pp_7d']=round(a['delta_dose2_7d']/a['abspop_jun2020'] * 100, 1)
+        a['delta_dose1pp_30d']=round(a['delta_dose1_30d']/a['abspop_jun2020'] * 100, 1)
+        a['delta_dose2pp_30d']=round(a['delta_dose2_30d']/a['abspop_jun2020'] * 100, 1)
 
     col_groups = [ ['delta_dose1pp', 'delta_dose2pp'],
                     ['delta_dose1pp_7d', 'delta_dose2pp_7d'],
@@ -364,25 +622,28 @@ def heatmap_delta_data_dynamic(df, opt_ag, opt_aj, opt_as, headline_only=False):
 
     figs = []
     for y in col_groups:
-        x = a[xaxis].unique()
-
-        if xaxis == 'state':
-            a['state'] = pd.Categorical(a['state'], config.states_rank_heatmap)
+        if ci is not None:
             x = config.states_rank_heatmap
+            z = [cube_delta_row(cube, ci, i) for i in y]
+        else:
+            x = a[xaxis].unique()
 
-        z = []
-        for i in y:
-            row = np.ndarray.flatten(a.sort_values(xaxis)[i].values)
-            z.append(row)
+            if xaxis == 'state':
+                a['state'] = pd.Categorical(a['state'], config.states_rank_heatmap)
+                x = config.states_rank_heatmap
+
+            z = []
+            for i in y:
+                row = np.ndarray.flatten(a.sort_values(xaxis)[i].values)
+                z.append(row)
 
         y = ['Dose 1 ', 'Dose 2 ']
-        fig = ff.create_annotated_heatmap(z,x=list(x),y=list(y), colorscale='pubu')
+        fig = annotated_heatmap(z, x, y, colorscale='pubu')
 
         figs.append(fig)
 
     if headline_only:
         fig.update_xaxes(side='top')
-        fig.update_yaxes(autorange='reversed')
         fig.update_layout(
             title=dict(font=dict(size=18),
                         text='% coverage growth (16+) since yesterday',
@@ -399,19 +660,12 @@ def heatmap_delta_data_dynamic(df, opt_ag, opt_aj, opt_as, headline_only=False):
     subfig = make_subplots(rows=3, cols=1,
                             subplot_titles=("since yesterday", "in the last week", "in the last 30 days"),
                             vertical_spacing=0.1)
-    subfig.add_trace(figs[0].data[0],1,1)
-    subfig.add_trace(figs[1].data[0],2,1)
-    subfig.add_trace(figs[2].data[0],3,1)
-    annot0 = list(figs[0].layout.annotations)
-    annot1 = list(figs[1].layout.annotations)
-    annot2 = list(figs[2].layout.annotations)
-    for i in range(len(annot1)):
-        annot1[i]['xref'] = 'x2'
-        annot1[i]['yref'] = 'y2'
-    for i in range(len(annot2)):
-        annot2[i]['xref'] = 'x3'
-        annot2[i]['yref'] = 'y3'
-    subfig.update_layout(annotations=list(subfig['layout']['annotations'])+annot0+annot1+annot2)
+    # the cell texts are a trace of their own, they go to their subplot with the heatmap
+    for (row, fig) in enumerate(figs, 1):
+        for trace in fig.data:
+            subfig.add_trace(trace, row, 1)
+        subfig.update_xaxes(range=fig.layout.xaxis.range, row=row, col=1)
+        subfig.update_yaxes(range=fig.layout.yaxis.range, row=row, col=1)
 
     if opt_aj == '':
         atext='% coverage growth of {}'.format(opt_ag)
@@ -431,13 +685,17 @@ def heatmap_delta_data_dynamic(df, opt_ag, opt_aj, opt_as, headline_only=False):
             )
     # place the xlabel at the top of the table
     subfig.update_xaxes(side='top')
-    subfig.update_yaxes(autorange='reversed')
     subfig['layout']['yaxis']['domain'] = [0.7333,0.9333]
     subfig['layout']['yaxis2']['domain'] = [0.3667,0.5667]
     subfig['layout']['yaxis3']['domain'] = [0,0.2]
     return subfig
 
-def heatmap_data(sag_df, overall_state_df, col='dose1_pct', headline_only=False):
+def heatmap_frame(sag_df, overall_state_df, cap_col=None):
+    """
+    Latest coverage of every heatmap row and state: the age groups, tot 12+,
+    tot 16+, tot pop and the empty row, sorted by state and row.
+    cap_col: coverage column capped at 95 for the age groups and 16+
+    """
     sixteen_plus_df = overall_state_df.query('age_group == "16_or_above"')
     twelve_plus_df = overall_state_df.query('age_group == "12_or_above"')
 
@@ -447,7 +705,8 @@ def heatmap_data(sag_df, overall_state_df, col='dose1_pct', headline_only=False)
     # This is for each age group coverage, for 16+
     l_df = pd.concat([states_df, l_df])[['state', 'age_group', 'dose1_pct', 'dose2_pct']]
     l_df['age_group'] = np.where(l_df['age_group'] == '16_or_above', 'tot 16+' ,l_df['age_group'])
-    # l_df[col] = np.where(l_df[col] >= 94.99, 95, l_df[col])
+    if cap_col is not None:
+        l_df[cap_col] = np.where(l_df[cap_col] >= 94.99, 95, l_df[cap_col])
 
     # Adding the 12+ population
     l_df = pd.concat([compare.get_latest(twelve_plus_df), l_df])[['state', 'age_group', 'dose1_pct', 'dose2_pct']]
@@ -455,42 +714,54 @@ def heatmap_data(sag_df, overall_state_df, col='dose1_pct', headline_only=False)
 
     # adding the total population, using the dose counts from 12+ population
     l_df = add_custom_age_groups(l_df, compare.get_latest(twelve_plus_df))
-    l_df = l_df.sort_values(['state', 'age_group'])
+    return l_df.sort_values(['state', 'age_group'])
 
-    l_df['state'] = pd.Categorical(l_df['state'], config.states_rank_heatmap)
+def heatmap_matrix(l_df, col, x):
+    """
+    Rows x states matrix of col out of heatmap_frame, one pivot.
+    Returns the y labels (in the order of the sorted rows), the values and
+    which cells have a row in l_df
+    """
+    y = l_df['age_group'].unique()
+    m = l_df.assign(present=True).pivot(index='age_group', columns='state', values=[col, 'present'])
+    values = m[col].reindex(index=y, columns=x).astype(float)
+    present = m['present'].reindex(index=y, columns=x).notna().to_numpy()
+    return y, values, present
+
+def heatmap_rows(values, present):
+    # z rows for the annotated heatmap, a row only has the states it has data for.
+    # convert all values into a single decimal digit for better readibility
+    values = np.round(values.to_numpy(), 1)
+    return [values[r][present[r]].tolist() for r in range(len(values))]
+
+def heatmap_data(sag_df, overall_state_df, col='dose1_pct', headline_only=False):
+    l_df = heatmap_frame(sag_df, overall_state_df)
     if headline_only:
-        l_df = l_df[l_df['age_group'].isin(['tot 12+', 'tot 16+', 'tot pop'])]
+        l_df = l_df[l_df['age_group'].isin(HEATMAP_TOTALS)]
 
     x = config.states_rank_heatmap
-    y = l_df['age_group'].unique()
-    #z = [[state1, age_group1, state1_agegroup2...
-    #     [state2]
-    z = []
-    for i in y:
-        # convert all values into a single decimal digit for better readibility
-        row = round(l_df.query('age_group==@i').sort_values('state')[col], 1).to_list()
-        z.append(row)
+    y, values, present = heatmap_matrix(l_df, col, x)
+    return x, y, heatmap_rows(values, present)
 
-    return x, y, z
-
-def coverage_heatmap(sag_df, overall_state_df, c='dose1_pct', headline_only=False):
+def coverage_heatmap(sag_df, overall_state_df, c='dose1_pct', headline_only=False, cube=None, date=None):
     """
     Need to prepare data for easy plotting
+    With a heatmap_cube holding date, the tables are read from it instead
     """
 
     figs = []
+    ci = cube_index(cube, date)
 
     for (c, _, title) in config.vac_status_info:
-        x, y, z = heatmap_data(sag_df, overall_state_df, col=c, headline_only=headline_only)
+        if ci is not None:
+            x, y, z = cube_heatmap_data(cube, ci, col=c, headline_only=headline_only)
+        else:
+            x, y, z = heatmap_data(sag_df, overall_state_df, col=c, headline_only=headline_only)
         # can try earth, or blues for colorscale
-        fig = ff.create_annotated_heatmap(z,x=list(x),y=list(y), colorscale='pubu', zmin=0, zmax=100)
         # Hack of creating an illusion of an empty row between age groups and total populations
-        for i in fig.layout.annotations:
-            if i['y'] == "empty row":
-                i['text'] = ''
+        fig = annotated_heatmap(z, x, y, colorscale='pubu', blank_row='empty row', zmin=0, zmax=100)
         fig.data[0]['y'] = np.where(np.array(fig.data[0]['y']) == 'empty row', '', fig.data[0]['y'])
         ####
-        fig.update_yaxes(autorange='reversed')
         fig.update_layout(
             title=dict(font=dict(size=18),
                         text=title,
@@ -540,15 +811,8 @@ def subplot_practice(overall_state_df, overall_ag_df, sag_df):
 
 
 def volume_chart(df, **kwargs):
-    # determine if we're cutting by age_group or state
-    max_dose=df['delta_dose12'].max() * config.graph_max_scale
-    if kwargs['facet'] == "state":
-        # If we're grouping by states, we want to exclude 'state == AUS'
-        df = df.query('state != "AUS"')
-    else:
-        # If we're grouping by age-group...
-        max_dose=df.groupby('date')['delta_dose12'].sum().reset_index()['delta_dose12'].max()\
-                        * config.graph_max_scale
+    # If we're grouping by states, we want to exclude 'state == AUS'
+    df = dose_frame(df, kwargs['facet'] == "state")
 
     if kwargs['opt_autoscale'] == "off":
         columns = [i[0] for i in config.analysis_options[kwargs['opt_aa']]]
@@ -556,12 +820,9 @@ def volume_chart(df, **kwargs):
         max_y = max(df.groupby('date')[columns].sum().max())
         kwargs['range_y'] = [0 , max_y * 1.1]
 
-    df['delta_dose1_prop'] = round(100 * df['delta_dose1_mod'] / df.groupby('date')['delta_dose1_mod'].transform(sum), 2)
-    df['delta_dose2_prop'] = round(100 * df['delta_dose2_mod'] / df.groupby('date')['delta_dose2_mod'].transform(sum), 2)
-    df['delta_dose12_prop'] = round(100 * df['delta_dose12_mod'] / df.groupby('date')['delta_dose12_mod'].transform(sum), 2)
-
+    totals=df.groupby('date')[kwargs['y']].sum().reset_index()[kwargs['y']]
     if kwargs['y'] in ['delta_dose12_mod']:
-        max_y = max(df.groupby('date')[kwargs['y']].sum())
+        max_y = max(totals)
         kwargs['range_y'] = [0, max_y * 1.1]
 
     fig = px.bar(df, x='date', y=kwargs['y'], color=kwargs['color'],
@@ -574,7 +835,6 @@ def volume_chart(df, **kwargs):
                       margin=dict(l=0,r=0, t=80, b=20),
                       legend_title_text='',
             )
-    totals=df.groupby('date')[kwargs['y']].sum().reset_index()[kwargs['y']]
 
     layout_style(fig, **kwargs)
 
@@ -690,22 +950,12 @@ def facet_chart(df, opt_aa, **kwargs):
         pxtype=px.bar
         pkwargs['opacity']=1,
         pkwargs['range_y']=[0,100]
-        df['dose1_prop'] = round(100 * df['delta_dose1_mod'] / df['delta_dose12_mod'], 2)
-        df['dose2_prop'] =  100 - df['dose1_prop']
     else:
         pxtype=px.line
 
-    if kwargs['facet'] == "state" and opt_aa in ['Dose administered *est*', 'Dose administered (proportion) *est*']:
-        # If we're grouping by states, we want to exclude 'state == AUS'
-        df = df.query('state != "AUS"')
-    else:
-        # If we're grouping by age-group...
-        max_dose=df.groupby('date')['delta_dose12'].sum().reset_index()['delta_dose12'].max()\
-                        * config.graph_max_scale
-
-    df['delta_dose1_prop'] = round(100 * df['delta_dose1_mod'] / df.groupby('date')['delta_dose1_mod'].transform(sum), 2)
-    df['delta_dose2_prop'] = round(100 * df['delta_dose2_mod'] / df.groupby('date')['delta_dose2_mod'].transform(sum), 2)
-    df['delta_dose12_prop'] = round(100 * df['delta_dose12_mod'] / df.groupby('date')['delta_dose12_mod'].transform(sum), 2)
+    # If we're grouping by states, we want to exclude 'state == AUS'
+    df = dose_frame(df, kwargs['facet'] == "state" and
+                        opt_aa in ['Dose administered *est*', 'Dose administered (proportion) *est*'])
 
     fig=pxtype(df,
                 x='date',
@@ -771,7 +1021,8 @@ def facet_chart(df, opt_aa, **kwargs):
     elif kwargs['label_value'] == 'proportion (%)' and opt_aa == 'Dose 1 vs 2 Proportion':
         add_target_hline_mid(fig)
 
-    return fig
+    # the bars of the proportion chart are left as they are
+    return downsample(fig)
 
 
 def exp_facet_chart(df, opt_aa, **kwargs):
@@ -824,62 +1075,33 @@ def exp_facet_chart(df, opt_aa, **kwargs):
             yaxis=dict(fixedrange=True),
         )
 
-    return fig
+    return downsample(fig)
 
-def gap_heatmap_data(sag_df, overall_state_df, col='dose1_pct'):
-    l_df = compare.get_latest(sag_df)
-    l_df = l_df.query('state != "AUS"')
+def gap_heatmap_data(sag_df, overall_state_df, col='dose1_pct', cube=None, date=None):
+    ci = cube_index(cube, date)
+    if ci is not None:
+        x, y, z = cube_gap_data(cube, ci, col=col)
+        return gap_heatmap_fig(x, y, z, col)
 
-    states_rank_heatmap = ['ACT', 'NSW', 'VIC', 'TAS', 'SA', 'NT', 'QLD', 'WA']
-    # print(sorted(l_df['dose1_pct'])[-10:])
-    l_df[col] = np.where(l_df[col] >= 94.99, 95, l_df[col])
-
-    sixteen_plus_df = overall_state_df.query('age_group == "16_or_above"')
-    twelve_plus_df = overall_state_df.query('age_group == "12_or_above"')
-
-    states_df = compare.get_latest(sixteen_plus_df)
-    l_df = compare.get_latest(sag_df)
-
-    # This is for each age group coverage, for 16+
-    l_df = pd.concat([states_df, l_df])[['state', 'age_group', 'dose1_pct', 'dose2_pct']]
-    l_df['age_group'] = np.where(l_df['age_group'] == '16_or_above', 'tot 16+' ,l_df['age_group'])
-    l_df[col] = np.where(l_df[col] >= 94.99, 95, l_df[col])
-
-    # Adding the 12+ population
-    l_df = pd.concat([compare.get_latest(twelve_plus_df), l_df])[['state', 'age_group', 'dose1_pct', 'dose2_pct']]
-    l_df['age_group'] = np.where(l_df['age_group'] == '12_or_above', 'tot 12+' ,l_df['age_group'])
-
-    # adding the total population, using the dose counts from 12+ population
-    l_df = add_custom_age_groups(l_df, compare.get_latest(twelve_plus_df))
-    l_df = l_df.sort_values(['state', 'age_group'])
+    l_df = heatmap_frame(sag_df, overall_state_df, cap_col=col)
     l_df = l_df.query('state != "AUS"')
-    l_df['dose1_pct'] = np.where(l_df['age_group'] == "empty row", np.nan, l_df['dose1_pct'])
-    l_df['dose2_pct'] = np.where(l_df['age_group'] == "empty row", np.nan, l_df['dose2_pct'])
-    ####
+    l_df[col] = np.where(l_df['age_group'] == "empty row", np.nan, l_df[col])
 
-    l_df['gap'] = l_df.groupby('age_group')[col].transform(lambda x: x.max() - x)
+    # gap to the best state of each row
+    x = GAP_STATES
+    y, values, present = heatmap_matrix(l_df, col, x)
+    gap = values.rsub(values.max(axis=1), axis=0)
+    z = heatmap_rows(gap, present)
 
-    l_df['state'] = pd.Categorical(l_df['state'], states_rank_heatmap)
-    x = states_rank_heatmap
-    y = l_df['age_group'].unique()
-    #z = [[state1, age_group1, state1_agegroup2...
-    #     [state2]
-    z = []
-    for i in y:
-        # convert all values into a single decimal digit for better readibility
-        row = round(l_df.query('age_group==@i').sort_values('state')['gap'], 1).to_list()
-        z.append(row)
+    return gap_heatmap_fig(x, y, z, col)
 
+def gap_heatmap_fig(x, y, z, col):
     text_label = 'Dose 1 coverage gap'
     if col=='dose2_pct':
         text_label = 'Dose 2 coverage gap'
 
-    fig = ff.create_annotated_heatmap(z,x=list(x),y=list(y), colorscale='temps')
-    for i in fig.layout.annotations:
-        if i['y'] == "empty row":
-            i['text'] = ''
+    fig = annotated_heatmap(z, x, y, colorscale='temps', blank_row='empty row')
     fig.data[0]['y'] = np.where(np.array(fig.data[0]['y']) == 'empty row', '', fig.data[0]['y'])
-    fig.update_yaxes(autorange='reversed')
     fig.update_layout(
             title=dict(font=dict(size=18),
                         text=text_label,
@@ -898,6 +1120,8 @@ def gap_heatmap_data(sag_df, overall_state_df, col='dose1_pct'):
 
 def vaccine_milestone_chart(df):
     df['dose']=pd.Categorical(df['dose'])
+    # px turns numeric text into floats, plain python ints keep the labels as 40 not 40.0
+    df['milestone']=df['milestone'].astype(object)
     df.sort_values('date', inplace=True)
     df=df.reset_index(drop=True)
     ps = list(df['plot_size'])
@@ -5,6 +5,7 @@ import numpy as np
 import datetime
 import sys
 import os
+import weakref
 
 import matplotlib.pyplot as plt
 
@@ -26,11 +27,7 @@ vaccine_count_colname = {0: ('unvac', 'unvac_pct', 'are not yet vaccinated'),
                          2: ('dose2_cnt', 'dose2_pct', 'are fully vaccinated')}
 
 def state_comparison(user, overall_state_df):
-    as_df = get_latest(overall_state_df)
-    as_df = rank_columns(as_df)
-    # print(as_df)
-    # print(user)
-    s = as_df.query('state== @user.state').to_dict(orient = 'records')[0]
+    s = latest_records(overall_state_df, 'state')[user.state]
     user_state_vac_count, user_state_vac_pp, user_state_vac_count_str = vaccine_count_colname[user.vac_status]
 
     comment = dict()
@@ -43,9 +40,7 @@ def state_comparison(user, overall_state_df):
 
 
 def ag_comparison(user, overall_ag_df):
-    aag_df = get_latest(overall_ag_df)
-    aag_df = rank_columns(aag_df)
-    s = aag_df.query('age_group==@user.age_group').to_dict(orient = 'records')[0]
+    s = latest_records(overall_ag_df, 'age_group')[user.age_group]
     user_ag_vac_count, user_ag_vac_pp, user_ag_vac_count_str = vaccine_count_colname[user.vac_status]
 
     comment = dict()
@@ -58,15 +53,9 @@ def ag_comparison(user, overall_ag_df):
 
 
 def state_age_group_comparison(user, sag_df):
-    ag_df = get_latest(sag_df)
-    ag_df = ag_df.query('state == @user.state | age_group == @user.age_group')
-
-    ag_in_state_df = rank_columns(ag_df.query('state == @user.state').copy(deep=True))
-    ag_out_state_df = rank_columns(ag_df.query('age_group == @user.age_group').copy(deep=True))
-    total_ag = ag_in_state_df.shape[0]
-
-    s = ag_in_state_df.query('state== @user.state & age_group == @user.age_group').to_dict(orient = 'records')[0]
-    s_out = ag_out_state_df.query('state== @user.state & age_group == @user.age_group').to_dict(orient = 'records')[0]
+    # ranked across the age groups of the state, and across the states for the age group
+    s = latest_records_within(sag_df, 'state')[(user.state, user.age_group)]
+    s_out = latest_records_within(sag_df, 'age_group')[(user.state, user.age_group)]
 
     user_vac_count, user_vac_pp, user_vac_count_str = vaccine_count_colname[user.vac_status]
 
@@ -89,11 +78,12 @@ def best_state_strs(user, s, c_df, age_group=False):
     user is a dict
     c_df stands for comparison_df
     """
-    _, best_state_vac_rate, best_state_vac_rate_pp = list(rank_columns(get_latest(c_df)).query('vac_rate_rank==1')[['state', 'vac_rate']].to_records())[0]
-    _, best_state_dose1, best_state_dose1_pp = list(rank_columns(get_latest(c_df)).query('dose1_rank==1')[['state', 'dose1_pct']].to_records())[0]
-    _, best_state_dose2, best_state_dose2_pp = list(rank_columns(get_latest(c_df)).query('dose2_rank==1')[['state', 'dose2_pct']].to_records())[0]
-    _, best_state_eta_70, best_state_eta_70_time, best_state_70_reached = list(rank_columns(get_latest(c_df)).query('eta_dose2_70_rank==1')[['state', 'eta_dose2_70', 'eta_dose2_70_y']].to_records())[0]
-    _, best_state_eta_80, best_state_eta_80_time, best_state_80_reached = list(rank_columns(get_latest(c_df)).query('eta_dose2_70_rank==1')[['state', 'eta_dose2_80', 'eta_dose2_80_y']].to_records())[0]
+    ranked = latest_ranked(c_df)
+    _, best_state_vac_rate, best_state_vac_rate_pp = list(ranked.query('vac_rate_rank==1')[['state', 'vac_rate']].to_records())[0]
+    _, best_state_dose1, best_state_dose1_pp = list(ranked.query('dose1_rank==1')[['state', 'dose1_pct']].to_records())[0]
+    _, best_state_dose2, best_state_dose2_pp = list(ranked.query('dose2_rank==1')[['state', 'dose2_pct']].to_records())[0]
+    _, best_state_eta_70, best_state_eta_70_time, best_state_70_reached = list(ranked.query('eta_dose2_70_rank==1')[['state', 'eta_dose2_70', 'eta_dose2_70_y']].to_records())[0]
+    _, best_state_eta_80, best_state_eta_80_time, best_state_80_reached = list(ranked.query('eta_dose2_70_rank==1')[['state', 'eta_dose2_80', 'eta_dose2_80_y']].to_records())[0]
 
     best_state_70_reached = pd.to_datetime(best_state_70_reached).date()
     best_state_80_reached = pd.to_datetime(best_state_80_reached).date()
@@ -148,10 +138,93 @@ class User:
         return getattr(self, item)
 
 def get_latest(df, spec_date=None):
-    date_max = df['date'].max()
-    if spec_date != None:
-        date_max = spec_date
-    return df.query('date == @date_max')
+    # rows of the latest date, or of spec_date.
+    # The processed frames are sorted by date, so that's a binary search and a
+    # slice; a frame that isn't sorted is scanned
+    dates = sorted_dates(df)
+    if dates is None:
+        date_max = df['date'].max()
+        if spec_date != None:
+            date_max = spec_date
+        return df.query('date == @date_max')
+
+    if len(dates) == 0:
+        return df.copy()
+    date = dates[-1] if spec_date is None else np.datetime64(pd.Timestamp(spec_date))
+    return df.iloc[np.searchsorted(dates, date, side='left'):np.searchsorted(dates, date, side='right')].copy()
+
+# Latest snapshots with all the ranks and eta dates, worked out once per frame.
+# The frames come from datacache.current(), so the same frame object
+# means the same data version; an entry goes away with its frame.
+# The cached frames and records are shared, treat them as read only
+_latest_cache = dict()
+
+def cached(df, name, build):
+    entry = _latest_cache.get(id(df))
+    if entry is None or entry['ref']() is not df:
+        key = id(df)
+        # the cache is bound to the callback, it may run at exit after the module globals are gone
+        entry = {'ref': weakref.ref(df, lambda _, cache=_latest_cache: cache.pop(key, None))}
+        _latest_cache[key] = entry
+    if name not in entry:
+        entry[name] = build()
+    return entry[name]
+
+def read_only(df):
+    # in-place writes to the values of a shared frame fail instead of changing it for
+    # everybody. Adding or re-assigning a column isn't caught, code doing that works
+    # on a .copy(). This goes through pandas internals (datetime and categorical
+    # blocks keep their numpy array in _ndarray); where a pandas release has them
+    # differently the frame is left writable
+    try:
+        blocks = df._mgr.blocks
+    except AttributeError:
+        return df
+    for blk in blocks:
+        arr = getattr(blk.values, '_ndarray', blk.values)
+        if isinstance(arr, np.ndarray):
+            try:
+                arr.flags.writeable = False
+            except ValueError:
+                # a view of an array someone else owns
+                pass
+    return df
+
+def sorted_dates(df):
+    # the date column as an array if df is sorted by date, None otherwise
+    def build():
+        dates = df['date'].to_numpy()
+        return dates if (dates[1:] >= dates[:-1]).all() else None
+    return cached(df, 'dates', build)
+
+def latest_ranked(df):
+    # rank_columns(get_latest(df))
+    return cached(df, 'ranked', lambda: rank_columns(get_latest(df)))
+
+def latest_records(df, by):
+    # the ranked latest rows as a lookup on the `by` column, first row wins
+    def build():
+        records = dict()
+        for r in latest_ranked(df).to_dict(orient='records'):
+            records.setdefault(r[by], r)
+        return records
+    return cached(df, ('records', by), build)
+
+def latest_records_within(df, by):
+    # latest rows ranked within each value of `by`, as a lookup on (state, age_group).
+    # A group rank_columns fails on is left out, only its own rows miss
+    def build():
+        records = dict()
+        for value, sub in get_latest(df).groupby(by, observed=True, sort=False):
+            try:
+                ranked = rank_columns(sub.copy(deep=True))
+            except Exception as e:
+                print('compare: no {} {!r} rankings: {!r}'.format(by, value, e), file=sys.stderr)
+                continue
+            for r in ranked.to_dict(orient='records'):
+                records.setdefault((r['state'], r['age_group']), r)
+        return records
+    return cached(df, ('within', by), build)
 
 def rank_columns(df):
     df['vac_rate_rank'] = df['vac_rate'].rank(method='first', ascending=False).astype(int)
@@ -198,8 +271,7 @@ def construct_eta_data(df, group_col, user, dose='dose2'):
     eta_95_col = 'eta_' + dose +  '_95_y'
 
     cols=['date', group_col , eta_70_col, eta_80_col, eta_95_col]
-    eta_df = get_latest(df)
-    eta_df = rank_columns(eta_df)
+    eta_df = latest_ranked(df)
     eta_df = eta_df[cols].reset_index(drop=True).sort_values(group_col)
     eta_df = eta_df.sort_values(group_col)
     eta_df['annot_y'] = eta_df[group_col].reset_index(drop=True).index.astype(int)
@@ -61,3 +61,38 @@ jur_only=['Jurisdictions']
 
 MIN_AGE=16
 MAX_AGE=999
+
+# AIR feeds, mirrored locally by store.py
+feeds = {'air_residence' : 'https://vaccinedata.covid19nearme.com.au/data/air_residence.csv',
+         'air' : 'https://vaccinedata.covid19nearme.com.au/data/air.csv'}
+store_dir = 'store'
+fetch_timeout = 30
+
+# processed frames cache, see artifacts.py
+artifact_dir = 'artifacts'
+artifact_keep = 3
+# off when precompute.py builds the artifacts on a schedule, the server
+# processes then only load the versions it publishes
+refresh_in_server = True
+# files in the repo that also feed the processed frames or the precompute.py tables
+static_sources = ['national_pop.csv', 'state_total_pop.csv']
+
+# when new data gets published (local time), see scheduler.py.
+# Checks back off from poll_min_seconds to poll_max_seconds while waiting for it
+publish_tz = 'Australia/Sydney'
+publish_window = ['09:00', '13:00']
+poll_min_seconds = 300
+poll_max_seconds = 1800
+
+# figure json kept in memory by figcache.py
+figure_cache_mb = 128
+# processes and option combinations per task when precompute.py renders the figures of a data version
+prerender_workers = 4
+prerender_chunk = 8
+# most points each line of the line and facet charts is drawn with, a longer
+# history is downsampled to it (see chart.downsample). None draws every day
+chart_max_points = 400
+
+# where daily-graph.py writes the images to post, and the processes rendering them
+image_dir = 'images'
+image_workers = 4
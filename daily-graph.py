@@ -9,10 +9,11 @@ import compare
 import data
 import chart
 import config
-from wand.image import Image
+import posts
+import plotly.graph_objects as go
 
 
-(df, overall_state_df, overall_ag_df, sag_df, milestone_df) = data.processing_data()
+(df, overall_state_df, overall_ag_df, sag_df, milestone_df) = data.processing_data(refresh=True)
 list_states = config.states_rank
 list_age_group = list(sorted(overall_ag_df['age_group'].unique()))
 latest_date = df['date'].max().date().strftime('%d %b %Y')
@@ -72,6 +73,10 @@ fig3 = chart.heatmap_delta_data_dynamic(heatmap_df, "16+ population", "", "Juris
 copyright_text='Based on AUS Department of Health report on {} <br> extracted by Ken Tsang @jxeeno'.format(latest_date)
 copyright_text = copyright_text + ', prepared by ausvacrace.info'
 
+# (file name, figures, stacked) of the images to post, see posts.write_posts.
+# The figures are copied as they are laid out for each post
+post_list = []
+
 # ======================================================
 
 fig1.update_layout(
@@ -100,18 +105,7 @@ fig3.update_layout(margin=dict(l=10,r=10, t=110, b=20),
                    title=dict(text='<br> <br> % coverage growth of 16+ population', y=0.97))
 
 
-fig1.write_image('images/fig1-wm-{}.png'.format(latest_date))
-fig2.write_image('images/fig2-wm-{}.png'.format(latest_date))
-fig3.write_image('images/fig3-wm-{}.png'.format(latest_date))
-one = Image(filename='images/fig1-wm-{}.png'.format(latest_date))
-two = Image(filename='images/fig2-wm-{}.png'.format(latest_date))
-three = Image(filename='images/fig3-wm-{}.png'.format(latest_date))
-
-with one as output:
-    output.sequence.append(two)
-    output.sequence.append(three)
-    output.smush(True, 1)
-    output.save(filename='images/wand-123-{}.png'.format(latest_date))
+post_list.append(('wand-123-{}.png'.format(latest_date), [go.Figure(f) for f in [fig1, fig2, fig3]], True))
 
 
 fig1.update_layout(
@@ -130,18 +124,7 @@ fig3.update_layout(margin=dict(l=10,r=10, t=100, b=0),
                    title=dict(text='<br> <br> % coverage growth of 16+ population', y=0.965),
                    height=600)
 
-fig1.write_image('images/fig4-wm-{}.png'.format(latest_date))
-fig2.write_image('images/fig5-wm-{}.png'.format(latest_date))
-fig3.write_image('images/fig6-wm-{}.png'.format(latest_date))
-one = Image(filename='images/fig4-wm-{}.png'.format(latest_date))
-two = Image(filename='images/fig5-wm-{}.png'.format(latest_date))
-three = Image(filename='images/fig6-wm-{}.png'.format(latest_date))
-
-with one as output:
-    output.sequence.append(two)
-    output.sequence.append(three)
-    output.smush(False, 1)
-    output.save(filename='images/wand-456-{}.png'.format(latest_date))
+post_list.append(('wand-456-{}.png'.format(latest_date), [go.Figure(f) for f in [fig1, fig2, fig3]], False))
 ###################################################
 
 
@@ -152,6 +135,7 @@ if extra_query != '':
 for px_info in config.analysis_options[opt_aa]:
     (px_settings['y'], px_settings['y_label'], px_settings['graph_title']) = px_info
     px_settings['opt_aa'] = opt_aa
+    px_settings['opt_autoscale'] = 'on'
     fig=chart.line_chart(plotly_df, **px_settings)
     growth_figs.append(fig)
 
@@ -177,18 +161,7 @@ fig3.update_layout(margin=dict(l=0,r=0, t=100, b=0),
                    title=dict(text='<br> <br> Dose 1 + 2 Growth Rate', y=0.99),
                    height=640, width=900, xaxis_title=None)
 
-fig1.write_image('images/fig1-growth-{}.png'.format(latest_date))
-fig2.write_image('images/fig2-growth-{}.png'.format(latest_date))
-fig3.write_image('images/fig3-growth-{}.png'.format(latest_date))
-one = Image(filename='images/fig1-growth-{}.png'.format(latest_date))
-two = Image(filename='images/fig2-growth-{}.png'.format(latest_date))
-three = Image(filename='images/fig3-growth-{}.png'.format(latest_date))
-
-with one as output:
-    output.sequence.append(two)
-    output.sequence.append(three)
-    output.smush(True, 1)
-    output.save(filename='images/growth-123-{}.png'.format(latest_date))
+post_list.append(('growth-123-{}.png'.format(latest_date), [go.Figure(f) for f in [fig1, fig2, fig3]], True))
 
 
 fig1.update_layout(
@@ -209,19 +182,9 @@ fig3.update_layout(margin=dict(l=0,r=0, t=120, b=0),
                    title=dict(text='<br> <br> Dose 1 + 2 Growth Rate', y=0.96),
                    height=640, width=900, xaxis_title=None)
 
-fig1.write_image('images/fig4-growth-{}.png'.format(latest_date))
-fig2.write_image('images/fig5-growth-{}.png'.format(latest_date))
-fig3.write_image('images/fig6-growth-{}.png'.format(latest_date))
-one = Image(filename='images/fig4-growth-{}.png'.format(latest_date))
-two = Image(filename='images/fig5-growth-{}.png'.format(latest_date))
-three = Image(filename='images/fig6-growth-{}.png'.format(latest_date))
-
-with one as output:
-    output.sequence.append(two)
-    output.sequence.append(three)
-    output.smush(False, 1)
-    output.save(filename='images/growth-456-{}.png'.format(latest_date))
+post_list.append(('growth-456-{}.png'.format(latest_date), [go.Figure(f) for f in [fig1, fig2, fig3]], False))
 #####################################################
 
-
-
+# only the posts whose figures changed since the last run are rendered again
+written = posts.write_posts(post_list)
+print('{} of {} images written to {}'.format(len(written), len(post_list), config.image_dir))
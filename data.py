@@ -5,9 +5,10 @@ import numpy as np
 import datetime
 import sys
 import os
-import streamlit as st
 import config
-import math
+import store
+import artifacts
+import compare
 
 from IPython.core.interactiveshell import InteractiveShell
 InteractiveShell.ast_node_interactivity = "all"
@@ -22,34 +23,85 @@ pd.options.mode.chained_assignment = None  # default='warn'
 
 np.set_printoptions(suppress=True)
 
+# bump whenever a change below alters the processed frames, so the cached
+# frames in artifacts/ are rebuilt
+PIPELINE_VERSION = 4
+
+# The feeds' schemas, declared up front so read_csv doesn't have to infer the
+# types and skips the columns we don't use.
+# Counts are float64 as they have gaps, and the national ones are too big to be
+# exact in float32. The percentages are only used for filtering, float32 is plenty
+RESIDENCE_COLS = {'DATE_AS_AT' : 'date',
+                  'STATE' : 'state',
+                  'AGE_LOWER' : 'age_lower',
+                  'AGE_UPPER' : 'age_upper',
+                  'AIR_RESIDENCE_FIRST_DOSE_PCT' : 'dose1_pct',
+                  'AIR_RESIDENCE_SECOND_DOSE_PCT' : 'dose2_pct',
+                  'AIR_RESIDENCE_FIRST_DOSE_COUNT' : 'first_dose_count',
+                  'AIR_RESIDENCE_SECOND_DOSE_COUNT' : 'second_dose_count',
+                  'AIR_RESIDENCE_FIRST_DOSE_APPROX_COUNT' : 'dose1_cnt',
+                  'AIR_RESIDENCE_SECOND_DOSE_APPROX_COUNT' : 'dose2_cnt',
+                  'ABS_ERP_JUN_2020_POP' : 'abspop_jun2020',
+                  'VALIDATED' : 'validated',
+                 }
+RESIDENCE_DTYPES = {'STATE' : str,
+                    'AGE_LOWER' : np.int16,
+                    'AGE_UPPER' : np.int16,
+                    'AIR_RESIDENCE_FIRST_DOSE_PCT' : np.float32,
+                    'AIR_RESIDENCE_SECOND_DOSE_PCT' : np.float32,
+                    'AIR_RESIDENCE_FIRST_DOSE_COUNT' : np.float64,
+                    'AIR_RESIDENCE_SECOND_DOSE_COUNT' : np.float64,
+                    'AIR_RESIDENCE_FIRST_DOSE_APPROX_COUNT' : np.float64,
+                    'AIR_RESIDENCE_SECOND_DOSE_APPROX_COUNT' : np.float64,
+                    'ABS_ERP_JUN_2020_POP' : np.float64,
+                    'VALIDATED' : 'category',
+                   }
+NATIONAL_DTYPES = {'PCT' : np.float32, 'COUNT' : np.float64, 'POPULATION' : np.float64}
+NATIONAL_COL_RE = r'^AIR_(?:AUS_)?(?P<age_lower>\d+)_(?P<age_upper>\d+|PLUS)_(?P<attr>FIRST_DOSE_PCT|SECOND_DOSE_PCT|FIRST_DOSE_COUNT|SECOND_DOSE_COUNT|POPULATION)$'
+NATIONAL_ATTRS = {'FIRST_DOSE_PCT' : 'dose1_pct',
+                  'SECOND_DOSE_PCT' : 'dose2_pct',
+                  'FIRST_DOSE_COUNT' : 'dose1_cnt',
+                  'SECOND_DOSE_COUNT' : 'dose2_cnt',
+                  'POPULATION' : 'abspop_jun2020',
+                 }
+# national age groups we use, in output order
+NATIONAL_AGE_GROUPS = [(12, 15), (16, 999), (50, 999), (70, 999), (95, 999), (16, 19)] + \
+                      [(i, i+4) for i in range(20, 95, 5)]
+
+# (age_lower, age_upper) -> age group label, as 5 year bands and as the alternate 10 year groups
+AGE_GROUPS = pd.DataFrame(
+    [(l, 999, '{}_or_above'.format(l), '{}_or_above'.format(l)) for l in [0, 12, 16, 50, 70]] +
+    [(12, 15, '12-15', '12-15')] +
+    [(l, u, '{}-{}'.format(l, u), '16-29' if l < 30 else '80+' if l >= 80 else '{}-{}'.format(l//10*10, l//10*10+9))
+        for (l, u) in [(16, 19)] + [(i, i+4) for i in range(20, 95, 5)]] +
+    [(95, 999, '95-999', '80+')],
+    columns=['age_lower', 'age_upper', 'age_group_5y', 'age_group_10y'])
+
+# Compact dtypes for the processed frames, see compact_dtypes.
+# Counts (people) fit comfortably in int32. The 7 day dose averages and the
+# eta columns are only ever turned into dates, float32 is plenty there
+COUNT_COLS = ['dose1_cnt', 'dose2_cnt', 'abspop_jun2020', 'unvac']
+RATE_COLS = ['ma7_dose1', 'ma7_dose2'] + \
+            ['eta_dose{}_{}'.format(d, t) for d in [1, 2] for t in [70, 80, 90, 95]]
+
+# coverage targets of the ETA tables on the page
+ETA_TARGETS = (70, 80, 90, 95)
+
 # @st.cache(suppress_st_warning=True, ttl=300)
 def get_data():
-    data_url = "https://vaccinedata.covid19nearme.com.au/data/air_residence.csv"
-    df = pd.read_csv(data_url)
-    df.at[3497, 'AIR_RESIDENCE_SECOND_DOSE_PCT'] = 24.41 # according to ABC
-    df.at[3497, 'AIR_RESIDENCE_SECOND_DOSE_COUNT'] = 516266
-    df = df.query('VALIDATED == "Y"')
-    df.drop(columns = ['URL', 'VALIDATED'], inplace = True)
-    cols= {'DATE_AS_AT' : 'DATE',
-           'AIR_RESIDENCE_FIRST_DOSE_PCT' : 'DOSE1_PCT',
-           'AIR_RESIDENCE_SECOND_DOSE_PCT' : 'DOSE2_PCT',
-           'AIR_RESIDENCE_FIRST_DOSE_COUNT' : 'FIRST_DOSE_COUNT',
-           'AIR_RESIDENCE_SECOND_DOSE_COUNT' : 'SECOND_DOSE_COUNT',
-           'AIR_RESIDENCE_FIRST_DOSE_APPROX_COUNT' : 'DOSE1_CNT',
-           'AIR_RESIDENCE_SECOND_DOSE_APPROX_COUNT' : 'DOSE2_CNT',
-           'ABS_ERP_JUN_2020_POP' : 'ABSPOP_JUN2020'
-          }
-
-    df.rename(columns = cols, inplace = True)
-    df['FIRST_DOSE_COUNT']=df['FIRST_DOSE_COUNT'].fillna(0).astype(int)
-    df['SECOND_DOSE_COUNT']=df['SECOND_DOSE_COUNT'].fillna(0).astype(int)
-    df['DOSE1_CNT']=df['DOSE1_CNT'].fillna(0).astype(int)
-    df['DOSE2_CNT']=df['DOSE2_CNT'].fillna(0).astype(int)
-    df['DOSE1_CNT']=df[['DOSE1_CNT', 'FIRST_DOSE_COUNT']].max(axis=1)
-    df['DOSE2_CNT']=df[['DOSE2_CNT', 'SECOND_DOSE_COUNT']].max(axis=1)
-    df.drop(columns=['FIRST_DOSE_COUNT', 'SECOND_DOSE_COUNT'], inplace=True)
-    df.columns = df.columns.str.lower()
-    df['date'] = pd.to_datetime(df['date'])
+    df = store.read_feed('air_residence', usecols=list(RESIDENCE_COLS), dtype=RESIDENCE_DTYPES,
+                         parse_dates=['DATE_AS_AT'])
+    df.rename(columns = RESIDENCE_COLS, inplace = True)
+    df.at[3497, 'dose2_pct'] = 24.41 # according to ABC
+    df.at[3497, 'second_dose_count'] = 516266
+    df = df.query('validated == "Y"')
+    df.drop(columns = ['validated'], inplace = True)
+
+    # take the larger of the exact and approximated counts, in one pass
+    counts = df[['dose1_cnt', 'first_dose_count', 'dose2_cnt', 'second_dose_count']].fillna(0).to_numpy(dtype=np.int64)
+    df['dose1_cnt'] = np.maximum(counts[:, 0], counts[:, 1])
+    df['dose2_cnt'] = np.maximum(counts[:, 2], counts[:, 3])
+    df.drop(columns=['first_dose_count', 'second_dose_count'], inplace=True)
     aus_df=get_national_data()
     twelveplus_df=create_12plus_data(df, aus_df)
     df=pd.concat([df,aus_df,twelveplus_df], ignore_index=True)
@@ -82,119 +134,139 @@ def create_12plus_data(df, aus_df):
 
     return new_df
 
+def national_columns():
+    """
+    The air.csv columns used by get_national_data, parsed from their names:
+    AIR_<lower>_<upper>_<ATTR>, or AIR_[AUS_]<lower>_PLUS_<ATTR> for open ended groups
+    """
+    names = store.read_header('air')
+    cols = pd.Series(names, index=names).str.extract(NATIONAL_COL_RE).dropna()
+    cols['age_lower'] = cols['age_lower'].astype(int)
+    cols['age_upper'] = cols['age_upper'].replace('PLUS', '999').astype(int)
+    cols = cols[pd.MultiIndex.from_frame(cols[['age_lower', 'age_upper']]).isin(NATIONAL_AGE_GROUPS)]
+    cols['dtype'] = cols['attr'].str.rsplit('_', n=1).str[-1].map(NATIONAL_DTYPES)
+    return cols
+
 def get_national_data():
-    data_url = "https://vaccinedata.covid19nearme.com.au/data/air.csv"
-    df = pd.read_csv(data_url)
+    cols = national_columns()
+    df = store.read_feed('air', usecols=['DATE_AS_AT'] + list(cols.index), dtype=cols['dtype'].to_dict(),
+                         parse_dates=['DATE_AS_AT'])
+
+    # position of every (age group, attr) column in the frame, -1 where air.csv
+    # doesn't have it (e.g. population of the 5 year bands)
+    groups = pd.DataFrame(NATIONAL_AGE_GROUPS, columns=['age_lower', 'age_upper'])
+    attrs = list(NATIONAL_ATTRS)
+    pos = pd.Series(np.arange(len(cols)), index=pd.MultiIndex.from_frame(cols[['age_lower', 'age_upper', 'attr']]))
+    grid = pd.MultiIndex.from_arrays([np.repeat(groups['age_lower'], len(attrs)),
+                                      np.repeat(groups['age_upper'], len(attrs)),
+                                      attrs * len(groups)])
+    grid = pos.reindex(grid).fillna(-1).astype(int).to_numpy().reshape(len(groups), len(attrs))
+
+    # the whole wide -> long reshape is a single gather: date x (group, attr) -> (group, date) x attr
+    values = df[cols.index].to_numpy(dtype=np.float64)
+    values = np.hstack([values, np.full((len(df), 1), np.nan)])
+    values = values[:, grid].transpose(1, 0, 2).reshape(-1, len(attrs))
+
+    adf = pd.DataFrame(values, columns=[NATIONAL_ATTRS[a] for a in attrs])
+    adf.insert(0, 'date', np.tile(df['DATE_AS_AT'].to_numpy(), len(groups)))
+
+    # The groups in national_pop.csv (12-15, 5 year bands, 95+) take their population
+    # from there, the other open ended groups have it in air.csv
     national_pop_df = pd.read_csv('national_pop.csv')
-    age_prefix=['AIR_12_15_', 'AIR_AUS_16_PLUS_', 'AIR_AUS_50_PLUS_', 'AIR_AUS_70_PLUS_', 'AIR_95_PLUS_']
-    attr_suffix=['FIRST_DOSE_PCT', 'SECOND_DOSE_PCT', 'FIRST_DOSE_COUNT', 'SECOND_DOSE_COUNT', 'POPULATION']
-    rename_cols = ['date', 'dose1_pct', 'dose2_pct', 'dose1_cnt', 'dose2_cnt', 'abspop_jun2020', 'age_lower', 'age_upper']
-    adf=pd.DataFrame()
-    for p in age_prefix:
-        sub_df=pd.DataFrame()
-        cols=['DATE_AS_AT'] + [p+s for s in attr_suffix]
-        if p=="AIR_95_PLUS_":
-            cols=cols[:-1] # 95 plus doesn't have population information
-            sub_df = df[cols]
-            sub_df['POPULATION'] = 52912
-            sub_df['AGE_LOWER'] = 95
-            sub_df['AGE_UPPER'] = 999
-        elif p=="AIR_12_15_":
-            cols=cols[:-1] # 12-15 doesn't have population information
-            sub_df = df[cols]
-            sub_df['POPULATION'] = 1243990
-            sub_df['AGE_LOWER'] = 12
-            sub_df['AGE_UPPER'] = 15
-        else:
-            sub_df = df[cols]
-            sub_df['AGE_LOWER'] = int(p.split('_')[2])
-            sub_df['AGE_UPPER'] = 999
-
-        sub_df.columns = rename_cols
-        adf=pd.concat([adf, sub_df])
-
-    # special cases for 5 year ranges
-    attr_suffix=['FIRST_DOSE_PCT', 'SECOND_DOSE_PCT', 'FIRST_DOSE_COUNT', 'SECOND_DOSE_COUNT']
-    for i in [16] + list(range(20,95,5)):
-        lower=i
-        upper=i+4 if i != 16 else 19
-        ar=str(lower) + "-"+ str(upper)
-        col='AIR_{}_{}_'.format(lower,upper)
-        cols=['DATE_AS_AT'] + [col+s for s in attr_suffix]
-        sub_df = df[cols]
-        sub_df['POPULATION'] = national_pop_df.query('age_range==@ar')['pop'].iloc[0]
-        sub_df['AGE_LOWER'] = lower
-        sub_df['AGE_UPPER'] = upper
-        sub_df.columns = rename_cols
-        adf=pd.concat([adf, sub_df])
-
+    national_pop_df[['age_lower', 'age_upper']] = national_pop_df['age_range'].str.extract(r'^(\d+)(?:-(\d+)|\+)$').fillna('999').astype(int)
+    groups = groups.merge(national_pop_df[['age_lower', 'age_upper', 'pop']], how='left')
+    pop = np.repeat(groups['pop'].to_numpy(dtype=np.float64), len(df))
+    adf['abspop_jun2020'] = np.where(np.isnan(pop), adf['abspop_jun2020'], pop)
+    adf['age_lower'] = np.repeat(groups['age_lower'].to_numpy(), len(df))
+    adf['age_upper'] = np.repeat(groups['age_upper'].to_numpy(), len(df))
+    adf = adf.astype({'dose1_pct' : np.float32, 'dose2_pct' : np.float32})
     adf['state'] = 'AUS'
-    adf['date'] = pd.to_datetime(adf['date'])
 
     adf=adf.dropna()
     return adf
 
 def age_grouping(df, age_group_10_flag):
-    df['age_group'] = df['age_lower'].astype(str) + '-' + df['age_upper'].astype(str)
+    # Label the rows through the AGE_GROUPS table. The lookup is done once per distinct
+    # (age_lower, age_upper) pair, the rows just pick up the category code of their pair
+    label = 'age_group_10y' if age_group_10_flag else 'age_group_5y'
+    codes, pairs = pd.MultiIndex.from_frame(df[['age_lower', 'age_upper']]).factorize()
+    labels = AGE_GROUPS.set_index(['age_lower', 'age_upper'])[label].reindex(pairs)
+    # any other pair keeps a plain 'lower-upper' label
+    unknown = labels.isna().to_numpy()
+    labels[unknown] = ['{}-{}'.format(l, u) for (l, u) in pairs[unknown]]
+
+    categories = pd.Index(labels.unique()).sort_values()
+    df['age_group'] = pd.Categorical.from_codes(categories.get_indexer(labels)[codes], categories)
     if age_group_10_flag:
         df = age_grouping_10y(df)
 
-    m = df['age_group'] != "0-999"
-    df['age_group'].where(m, "0_or_above", inplace = True)
-    m = df['age_group'] != "12-999"
-    df['age_group'].where(m, "12_or_above", inplace = True)
-    m = df['age_group'] != "16-999"
-    df['age_group'].where(m, "16_or_above", inplace = True)
-    m = df['age_group'] != "50-999"
-    df['age_group'].where(m, "50_or_above", inplace = True)
-    m = df['age_group'] != "70-999"
-    df['age_group'].where(m, "70_or_above", inplace = True)
-
     return df
 
 def age_grouping_10y(df):
     """
-    Group the data into alternate age groups
-    Before going further, we need to aggregate data within these new groups
+    Aggregate the data within the alternate (10 year) age groups set by age_grouping
     """
 
-    df['age_group'] = np.where(df['age_group'].isin(['16-19', '20-24', '25-29']), '16-29',
-                        np.where(df['age_group'].isin(['30-34', '35-39']), '30-39',
-                        np.where(df['age_group'].isin(['40-44', '45-49']), '40-49',
-                        np.where(df['age_group'].isin(['50-54', '55-59']), '50-59',
-                        np.where(df['age_group'].isin(['60-64', '65-69']), '60-69',
-                        np.where(df['age_group'].isin(['70-74', '75-79']), '70-79',
-                        np.where(df['age_group'].isin(['80-84', '85-89']), '80+',
-                        np.where(df['age_group'].isin(['90-94', '95-999']), '80+', df['age_group']))))))))
-
     df=df.groupby(['date', 'state', 'age_group'])[['dose1_cnt', 'dose2_cnt', 'abspop_jun2020']].agg(sum).reset_index()
 
     return df
 
-def extra_calculation(a):
-    # Grouped extra calculation
-    a.sort_values('date', ascending = True, inplace=True)
-    a['delta_dose1'] = a['dose1_cnt'].diff()
-    a['delta_dose2'] = a['dose2_cnt'].diff()
-    a['delta_dose1_7d'] = a['dose1_cnt'].diff(7)
-    a['delta_dose2_7d'] = a['dose2_cnt'].diff(7)
-    a['delta_dose1_30d'] = a['dose1_cnt'].diff(30)
-    a['delta_dose2_30d'] = a['dose2_cnt'].diff(30)
+def extra_calculation(df, keys):
+    """
+    Grouped extra calculation, for all the groups in one go
+    Rows are sorted once by (group, date) and every column is computed over the
+    whole frame; diffs are masked at the start of each group and the moving
+    averages are one groupby rolling, so the numbers are the same as running
+    the calculation on each group separately
+    """
+    gid = df.groupby(keys, observed=True, sort=False).ngroup().to_numpy()
+    order = np.lexsort((df['date'].to_numpy(), gid))
+    # like groupby, rows with a missing key don't belong to any group
+    order = order[gid[order] >= 0]
+    a = df.take(order)
+    gid = gid[order]
+    rows = np.arange(len(a))
+    first = np.r_[True, gid[1:] != gid[:-1]]
+    pos = rows - np.maximum.accumulate(np.where(first, rows, 0))
+
+    def diff(col, n=1):
+        x = a[col].to_numpy()
+        res = np.full(len(x), np.nan)
+        res[n:] = x[n:] - x[:-n]
+        res[pos < n] = np.nan
+        return res
+
+    a['delta_dose1'] = diff('dose1_cnt')
+    a['delta_dose2'] = diff('dose2_cnt')
+    a['delta_dose1_7d'] = diff('dose1_cnt', 7)
+    a['delta_dose2_7d'] = diff('dose2_cnt', 7)
+    a['delta_dose1_30d'] = diff('dose1_cnt', 30)
+    a['delta_dose2_30d'] = diff('dose2_cnt', 30)
     a['delta_dose12'] = a['delta_dose1'] + a['delta_dose2']
     a['vac_rate'] = round(a['delta_dose12'] / a['abspop_jun2020'] * 100, 2)
     a['vac_rate'] = a['vac_rate'].clip(0)
-    a['ma7_vac_rate'] = round(a['vac_rate'].rolling(7).mean().replace(0, 0.01), 2)
-
 
     # modified delta, cap the minus values in delta into 0.
     # this is to handle days where for some reason or another the delta count is negative (i.e. there are less people getting vaccinated compared to the day before, probably due to data error
     # or change in data entry policy, e.g. classifying 96% to >95% -- see data notes in README
-    a['delta_dose1_mod'] = a['delta_dose1'].clip(0)
-    a['delta_dose2_mod'] = a['delta_dose2'].clip(0)
+    delta_dose1_mod = a['delta_dose1'].clip(0)
+    delta_dose2_mod = a['delta_dose2'].clip(0)
+    vac_rate_dose1 = round(a['delta_dose1'] / a['abspop_jun2020'] * 100, 2).clip(0)
+    vac_rate_dose2 = round(a['delta_dose2'] / a['abspop_jun2020'] * 100, 2).clip(0)
+
+    # all the 7 day moving averages, of every group at once
+    ma_in = pd.DataFrame({'vac_rate': a['vac_rate'], 'delta_dose1_mod': delta_dose1_mod,
+                          'delta_dose2_mod': delta_dose2_mod, 'vac_rate_dose1': vac_rate_dose1,
+                          'vac_rate_dose2': vac_rate_dose2})
+    ma = ma_in.groupby(gid, sort=False).rolling(7).mean().reset_index(level=0, drop=True)
+
+    a['ma7_vac_rate'] = round(ma['vac_rate'].replace(0, 0.01), 2)
+    a['delta_dose1_mod'] = delta_dose1_mod
+    a['delta_dose2_mod'] = delta_dose2_mod
     a['delta_dose12_mod'] = a['delta_dose1_mod'] + a['delta_dose2_mod']
     # replacing 0 in moving average with small values to make sure we're not predicting infinity
-    a['ma7_dose1'] = a['delta_dose1_mod'].rolling(7).mean().replace(0, 0.01)
-    a['ma7_dose2'] = a['delta_dose2_mod'].rolling(7).mean().replace(0, 0.01)
+    a['ma7_dose1'] = ma['delta_dose1_mod'].replace(0, 0.01)
+    a['ma7_dose2'] = ma['delta_dose2_mod'].replace(0, 0.01)
     a['unvac'] = a['abspop_jun2020'] - a['dose1_cnt']
     a['unvac_pct'] = round(a['unvac']/a['abspop_jun2020'] *100, 2)
 
@@ -204,24 +276,26 @@ def extra_calculation(a):
     a['eta_dose2_90'] = (0.9 * a['abspop_jun2020'] - a['dose2_cnt']) / a['ma7_dose2']
     a['eta_dose2_95'] = (0.95 * a['abspop_jun2020'] - a['dose2_cnt']) / a['ma7_dose2']
 
-
-    a['vac_rate_dose1'] = round(a['delta_dose1'] / a['abspop_jun2020'] * 100, 2)
-    a['vac_rate_dose1'] = a['vac_rate_dose1'].clip(0)
-    a['ma7_dose1_vac_rate'] = round(a['vac_rate_dose1'].rolling(7).mean().replace(0, 0.001), 2)
-
-    a['vac_rate_dose2'] = round(a['delta_dose2'] / a['abspop_jun2020'] * 100, 2)
-    a['vac_rate_dose2'] = a['vac_rate_dose2'].clip(0)
-    a['ma7_dose2_vac_rate'] = round(a['vac_rate_dose2'].rolling(7).mean().replace(0, 0.001), 2)
+    a['vac_rate_dose1'] = vac_rate_dose1
+    a['ma7_dose1_vac_rate'] = round(ma['vac_rate_dose1'].replace(0, 0.001), 2)
+    a['vac_rate_dose2'] = vac_rate_dose2
+    a['ma7_dose2_vac_rate'] = round(ma['vac_rate_dose2'].replace(0, 0.001), 2)
 
     a['eta_dose1_70'] = (0.7 * a['abspop_jun2020'] - a['dose1_cnt']) / a['ma7_dose1']
     a['eta_dose1_80'] = (0.8 * a['abspop_jun2020'] - a['dose1_cnt']) / a['ma7_dose1']
     a['eta_dose1_90'] = (0.9 * a['abspop_jun2020'] - a['dose1_cnt']) / a['ma7_dose1']
     a['eta_dose1_95'] = (0.95 * a['abspop_jun2020'] - a['dose1_cnt']) / a['ma7_dose1']
 
-    return a
+    # back to the order the rows came in
+    return a.take(np.argsort(order, kind='stable'))
 
 # @st.cache(suppress_st_warning=True, ttl=300)
 def process_data(df):
+    (overall_state_df, overall_ag_df, sag_df) = process_frames(df)
+    milestone_df=get_major_milestone_data(overall_state_df)
+    return (overall_state_df, overall_ag_df, sag_df, milestone_df)
+
+def process_frames(df):
     overall_state_df = df[df['age_group'].str.endswith('_or_above')].copy(deep = True)
     overall_ag_df = df[~df['age_group'].str.endswith('_or_above')].copy(deep = True)
     sag_df = df[~df['age_group'].str.endswith('_or_above')].copy(deep = True)
@@ -230,16 +304,16 @@ def process_data(df):
     overall_state_df['dose1_pct'] = round(100 * overall_state_df['dose1_cnt']/ overall_state_df['abspop_jun2020'], 2)
     overall_state_df['dose2_pct'] = round(100 * overall_state_df['dose2_cnt']/ overall_state_df['abspop_jun2020'], 2)
     overall_state_df = overall_state_df.query('age_group == "16_or_above" | age_group == "12_or_above"')
-    overall_state_df = overall_state_df.groupby(['age_group', 'state']).apply(lambda d: extra_calculation(d))
+    overall_state_df = extra_calculation(overall_state_df, ['age_group', 'state'])
 
     # further preprocessing for overall_ag_df
     overall_ag_df = overall_ag_df.query('state == "AUS"')
     overall_ag_df['dose1_pct'] = round(100 * overall_ag_df['dose1_cnt']/ overall_ag_df['abspop_jun2020'], 3)
     overall_ag_df['dose2_pct'] = round(100 * overall_ag_df['dose2_cnt']/ overall_ag_df['abspop_jun2020'], 3)
-    overall_ag_df = overall_ag_df.groupby('age_group').apply(lambda d: extra_calculation(d))
+    overall_ag_df = extra_calculation(overall_ag_df, ['age_group'])
 
     # further preprocessing for sag_df
-    sag_df = sag_df.groupby(['state', 'age_group']).apply(lambda d: extra_calculation(d))
+    sag_df = extra_calculation(sag_df, ['state', 'age_group'])
     sag_df['dose1_pct'] = round(100 * sag_df['dose1_cnt']/ sag_df['abspop_jun2020'], 2)
     sag_df['dose2_pct'] = round(100 * sag_df['dose2_cnt']/ sag_df['abspop_jun2020'], 2)
     sag_df.sort_values(['date', 'state', 'age_group'], ascending=[True, True, True], inplace=True)
@@ -248,8 +322,36 @@ def process_data(df):
     # overall_ag_df.to_csv('sample_overall_ag_df-20210926.csv', index=False)
     # sag_df.to_csv('sample_sag_df-20210926.csv', index=False)
 
-    milestone_df=get_major_milestone_data(overall_state_df)
-    return (overall_state_df, overall_ag_df, sag_df, milestone_df)
+    overall_state_df = compact_dtypes(overall_state_df)
+    overall_ag_df = compact_dtypes(overall_ag_df)
+    sag_df = compact_dtypes(sag_df)
+
+    # sorted by date, so the rows of one date are a slice (see compare.get_latest)
+    overall_state_df = overall_state_df.sort_values('date', kind='stable')
+    overall_ag_df = overall_ag_df.sort_values('date', kind='stable')
+    return (overall_state_df, overall_ag_df, sag_df)
+
+def compact_dtypes(f):
+    """
+    int32 counts, float32 dose rates / etas, and the state and age_group
+    categories in the config.states_rank / config.ag_rank order
+    The rounded percentages, rates and the deltas stay float64, they are shown
+    as is in the charts where float32 would come out as e.g. 45.279998779296875
+    """
+    f = f.astype({**{c: np.int32 for c in COUNT_COLS if c in f},
+                  **{c: np.float32 for c in RATE_COLS if c in f}})
+    for col, rank in [('state', config.states_rank), ('age_group', config.ag_rank)]:
+        if col in f:
+            cats = list(f[col].astype('category').cat.categories)
+            ranked = [c for c in rank if c in cats] + [c for c in cats if c not in rank]
+            f[col] = pd.Categorical(f[col], ranked)
+    return f
+
+def memory_report(frames, names=('df', 'overall_state_df', 'overall_ag_df', 'sag_df', 'milestone_df')):
+    # memory footprint of each frame, in MB
+    return pd.DataFrame([(n, f.shape[0], f.shape[1], round(f.memory_usage(deep=True).sum() / 2**20, 3))
+                         for (n, f) in zip(names, frames)],
+                        columns=['frame', 'rows', 'cols', 'MB']).set_index('frame')
 
 def save_data(df):
     return process_data(df)
@@ -279,106 +381,158 @@ def find_age_group(df, age):
 
 #
 # overall_state_df
-def get_major_milestone_data(df):
+def get_major_milestone_data(df, major_milestones=(40, 50, 60, 70, 80, 90, 95),
+                                  plot_size=(1, 1.5,  2,  3,  4,  5, 5.5)):
     list_states = config.states_rank
-    major_milestones = [40, 50, 60, 70, 80, 90, 95]
-    plot_size =        [1, 1.5,  2,  3,  4,  5, 5.5]
     cols = ['state', 'age_group', 'date', 'dose', 'milestone', 'text_label', 'plot_size']
+    targets = np.asarray(major_milestones, dtype=float)
 
-    output_df = pd.DataFrame(columns=cols)
-
+    a = df[df['age_group'] == '16_or_above'].sort_values('date', kind='stable')
+    rows = []
     for state in list_states:
-        for (m, ps) in zip(major_milestones, plot_size):
+        x = a[a['state'] == state]
+        dates = x['date'].dt.date.to_numpy()
+        found = dict()
+        for d in ['dose1_pct', 'dose2_pct']:
+            v = x[d].to_numpy(dtype=float)
+            # running max of the coverage, the first date above a milestone is then
+            # a searchsorted even if the series dips now and then
+            reached = np.fmax.accumulate(np.where(np.isnan(v), -np.inf, v)) if len(v) else v
+            idx = np.searchsorted(reached, targets, side='right')
+            # only milestones crossed within the data, not the ones the state started above
+            lowest = np.min(np.where(np.isnan(v), np.inf, v), initial=np.inf)
+            found[d] = np.where((idx < len(v)) & (lowest < targets), idx, -1)
+
+        for (i, (m, ps)) in enumerate(zip(major_milestones, plot_size)):
             for d in ['dose1_pct', 'dose2_pct']:
-                row = dict()
-                row['state'] = state
-                row['age_group'] = '16+'
-                row['date'] = find_first(df, state, m, col=d, ag='16_or_above')
-                if pd.isnull(row['date']):
+                if found[d][i] < 0:
                     continue
-                row['dose'] =  'dose 1' if d == 'dose1_pct' else 'dose 2'
-                row['milestone'] = m
-                # if m == 95:
-                #     row['milestone'] = '🏁 95'
-                row['text_label'] = str(m)+'%💉' if d == 'dose1_pct' else str(m) + '%💉💉'
-                row['text_label'] = row['text_label'] + '<br>'+str(row['date'].strftime('%d %b'))
-                row['plot_size'] = ps
-                output_df = output_df.append(row, ignore_index=True)
-
-    return output_df
-
-
-def find_first(df, state, target, col='dose1_pct', ag='16_or_above'):
-    date = None
-    try:
-        # check if the first entry is the one after the target
-        if df[(df['state'] == state) & (df[col] < target) & (df['age_group'] == ag)].shape[0] == 0:
-            date = None
-            return date
-
-        date = df[(df['state'] == state) & (df[col] > target) & (df['age_group'] == ag)]['date'].min().date()
-    except:
-        date = None
-
-    return date
-
-def predict_target_date_1stdose(x, t):
-    # Return the date a jurisdiction reaches the first-dose target
-    # t is the dose target
-    if x[x['dose1_pct'] > t].shape[0] > 0:
-        first_date_reach_target = x[x['dose1_pct'] > t]['date'].min()
-        return first_date_reach_target.date().strftime('%d %b %Y') + '🏁'
-
-    # otherwise, we estimate the target
-    else:
-        straight_eta1_togo = math.ceil(x['eta_dose1_'+str(t)].tail(1).item())
-        straight_eta1_proj_date = (x['date'].max() + datetime.timedelta(days=straight_eta1_togo)).date()
-
-        return straight_eta1_proj_date.strftime('%d %b %Y')
+                date = dates[found[d][i]]
+                dose, emoji = ('dose 1', '💉') if d == 'dose1_pct' else ('dose 2', '💉💉')
+                rows.append((state, '16+', date, dose, m,
+                             str(m) + '%' + emoji + '<br>' + date.strftime('%d %b'), ps))
 
+    return pd.DataFrame(rows, columns=cols)
 
-def predict_target_date(x, t):
-    # Return the date a jurisdiction reaches the double-dose target
-    # t is the double dose target
-    if x[x['dose2_pct'] > t].shape[0] > 0:
-        first_date_reach_target = x[x['dose2_pct'] > t]['date'].min()
-        return first_date_reach_target.date().strftime('%d %b %Y') + '🏁'
-
-    # otherwise, we estimate the target
-    else:
-        straight_eta2_togo = math.ceil(x['eta_dose2_'+str(t)].tail(1).item())
-        straight_eta2_proj_date = (x['date'].max() + datetime.timedelta(days=straight_eta2_togo)).date()
-
-        cur2nd = x['dose2_pct'].max()
-        cur2nd_dose1date = x[x['dose1_pct'] > cur2nd]['date'].min()
-
-        # we don't know when the 1st target will hit, so use the eta to target
-        if x['dose1_pct'].max() < t:
-            straight_eta1_togo = math.ceil(x['eta_dose1_'+str(t)].tail(1).item())
-            target1stdate = x['date'].max() + datetime.timedelta(days=straight_eta1_togo)
-        else:
-            target1stdate = x[x['dose1_pct'] >= t]['date'].min()
-
-        follow_dose1_proj_date = (x['date'].max() + (target1stdate - cur2nd_dose1date)).date()
-
-        if straight_eta2_proj_date != follow_dose1_proj_date:
-            return ' to '.join(map(lambda x: x.strftime('%d %b %Y'), sorted([straight_eta2_proj_date, follow_dose1_proj_date])))
-        else:
-            return follow_dose1_proj_date.strftime('%d %b %Y')
 
-@st.cache(suppress_st_warning=True, ttl=300)
-def processing_data():
-    # cache wrapper #
-    df = get_data()
+def predict_target_dates(df, targets=ETA_TARGETS):
+    """
+    Estimated dates for every jurisdiction to reach every target, both doses in one pass
+    Returns (1st dose table, 2nd dose table): a 'state' column in
+    config.states_rank_heatmap order and a 'target-<t>' column per target.
+    - target reached: the first date above it, with a 🏁
+    - 1st dose: straight 7-day MA estimate
+    - 2nd dose: the 7-day MA estimate and the "follow 1st dose" date, shown as an
+      interval when they differ. "follow 1st dose" assumes getting from today's 2nd
+      dose coverage to the target takes as long as it took the 1st dose, using the
+      1st dose estimate when the 1st dose hasn't got there yet
+    """
+    t = np.asarray(targets, dtype=float)
+    p = df.pivot(index='date', columns='state')
+    states = list(p['dose1_cnt'].columns)
+    dates = p.index.to_numpy()
+    n = len(dates)
+    # the latest row of each state
+    last = n - 1 - np.argmax(p['dose1_cnt'].notna().to_numpy()[::-1], axis=0)
+    at_last = lambda col: p[col].to_numpy(dtype=float)[last, np.arange(len(states))]
+    latest = dates[last]
+
+    def running_max(col):
+        # coverage so far, gaps don't count
+        v = p[col].to_numpy(dtype=float)
+        return np.fmax.accumulate(np.where(np.isnan(v), -np.inf, v), axis=0)
+
+    def first_date(reached, level, strict=True):
+        # first date above (or at) level, level is per state x target. reached only
+        # grows, so the rows still below the level are the ones before that date
+        below = (reached[:, :, None] <= level) if strict else (reached[:, :, None] < level)
+        idx = below.sum(axis=0)
+        return np.where(idx < n, dates[np.minimum(idx, n - 1)], np.datetime64('NaT'))
+
+    def eta(dose):
+        # days to go at the latest 7-day MA, the eta_dose<d>_<t> columns for any t
+        togo = (t[None, :] / 100 * at_last('abspop_jun2020')[:, None] - at_last('dose{}_cnt'.format(dose))[:, None]) \
+               / at_last('ma7_dose{}'.format(dose))[:, None]
+        return latest[:, None] + np.ceil(togo).astype('timedelta64[D]')
+
+    reached1 = running_max('dose1_pct')
+    reached2 = running_max('dose2_pct')
+    levels = np.broadcast_to(t, (len(states), len(t)))
+    reach1_date = first_date(reached1, levels)
+    reach2_date = first_date(reached2, levels)
+    straight1 = eta(1)
+    straight2 = eta(2)
+
+    cur2nd = np.where(np.isinf(reached2[-1]), np.nan, reached2[-1])
+    cur2nd_dose1date = first_date(reached1, np.broadcast_to(cur2nd[:, None], levels.shape))
+    max1st = np.where(np.isinf(reached1[-1]), np.nan, reached1[-1])
+    target1stdate = np.where(max1st[:, None] < t[None, :], straight1, first_date(reached1, levels, strict=False))
+    follow = latest[:, None] + (target1stdate - cur2nd_dose1date)
+
+    fmt = lambda d: pd.Timestamp(d).strftime('%d %b %Y')
+    dose1, dose2 = dict(), dict()
+    for j, target in enumerate(targets):
+        col = 'target-' + str(target)
+        dose1[col] = [fmt(r) + '🏁' if not np.isnat(r) else fmt(s)
+                      for (r, s) in zip(reach1_date[:, j], straight1[:, j])]
+        dose2[col] = [fmt(r) + '🏁' if not np.isnat(r) else
+                      ' to '.join(map(fmt, sorted([s, f]))) if s != f else fmt(f)
+                      for (r, s, f) in zip(reach2_date[:, j], straight2[:, j], follow[:, j])]
+
+    res = []
+    for d in [dose1, dose2]:
+        table = pd.DataFrame({'state': pd.Categorical(states, config.states_rank_heatmap), **d})
+        res.append(table.sort_values('state'))
+    return tuple(res)
+
+def eta_tables(overall_state_df, age_group):
+    # predict_target_dates of one overall_state_df age group, once per frame
+    return compare.cached(overall_state_df, ('eta', age_group),
+        lambda: predict_target_dates(overall_state_df[overall_state_df['age_group'] == age_group], ETA_TARGETS))
+
+def run_step(name, fn, *args):
+    # the pipeline runs each step through a step(name, fn, *args) like this one,
+    # precompute.py passes one timing them
+    return fn(*args)
+
+def build_frames(step=run_step):
+    """
+    The processed frames of the feeds as they are in the local store
+    """
+    df = step('ingest', get_data)
     age_group_10_flag = True
-    df = age_grouping(df, age_group_10_flag)
-    overall_state_df, overall_ag_df, sag_df, milestone_df = process_data(df)
-    # milestone_df=get_major_milestone_data(overall_state_df)
+    df = step('age_grouping', age_grouping, df, age_group_10_flag)
+    (overall_state_df, overall_ag_df, sag_df) = step('process_data', process_frames, df)
+    milestone_df = step('milestones', get_major_milestone_data, overall_state_df)
+    df = compact_dtypes(df)
     return (df, overall_state_df, overall_ag_df, sag_df, milestone_df)
 
-
-if __name__ == '__main__':
-    df = get_data()
-    aus_df=get_national_data()
-    adf = age_grouping(df, True)
-    a,b,c,d = save_data(adf)
+def versioned_frames(step=run_step, rebuild=False):
+    """
+    (data version, processed frames) of the feeds as they are in the local store.
+    The frames come from the artifact cache when that version was built before,
+    unless rebuild. Version is None when the feeds changed while the frames were
+    being built
+    """
+    version = step('version', artifacts.data_version, PIPELINE_VERSION)
+    frames = None if rebuild else step('load', artifacts.load_frames, version)
+    if frames is not None:
+        return version, frames
+
+    frames = build_frames(step)
+    # only store them if a refresh didn't change the feeds underneath us
+    if artifacts.data_version(PIPELINE_VERSION) != version:
+        return None, frames
+    step('save', artifacts.save_frames, version, frames)
+    return version, frames
+
+def processing_data(refresh=False):
+    # frames of the local snapshot, new rows are pulled in the background for
+    # the next call. With refresh the feeds are brought up to date first, for
+    # one-shot batch jobs that exit before a background refresh would land.
+    # The dashboard goes through datacache.current() instead
+    if refresh:
+        store.refresh()
+    else:
+        store.refresh_in_background()
+    return versioned_frames()[1]
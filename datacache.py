@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Stale-while-revalidate holder of the processed frames
+#
+# current() hands out the last good (version, frames) straight away, with no
+# hashing or copying on the way. When the schedule (scheduler.py) says new data
+# may be out, a background thread takes over: if this process gets the
+# artifacts publisher lock, it pulls the feeds, builds the frames of a new
+# version and publishes it for every process on the host, figures included.
+# Then, whoever did the work, the published version is mapped from the artifact
+# directory and its figures loaded into figcache before it is swapped in; no
+# process renders them again. Visitors keep getting the previous version until
+# then. Only the first call of a process, with nothing to serve yet, waits for
+# the frames. With config.refresh_in_server off, the
+# building is left to precompute.py and the thread only picks up what it
+# publishes.
+#
+# The frames are shared by every session, so their arrays are made read only:
+# code writing into their values fails instead of changing everybody's data.
+# Adding or replacing columns isn't caught, see compare.read_only.
+
+import sys
+import time
+import threading
+import store
+import artifacts
+import compare
+import config
+import data
+import figures
+import precompute
+import scheduler
+
+_lock = threading.RLock()
+_state = {'version': None, 'frames': None, 'checked': 0.0, 'refreshing': False, 'error': None}
+_schedule = scheduler.Schedule()
+
+
+def read_only(frames):
+    for f in frames:
+        compare.read_only(f)
+    return frames
+
+
+def update_feeds():
+    # publisher only: pull the feeds, build and publish the frames of a new version
+    try:
+        store.refresh()
+    except (OSError, ValueError):
+        # network trouble, check the snapshot we have anyway
+        pass
+    current = artifacts.current_version()
+    if (artifacts.data_version(data.PIPELINE_VERSION) != current
+            or not artifacts.has_tables(current, precompute.TABLES_VERSION)
+            or not artifacts.has_figures(current, figures.FIGURES_VERSION)):
+        precompute.build()
+
+
+def pick_up():
+    # swap in the published version when it isn't the one served already, with
+    # the figures the publisher rendered in figcache. A version without them
+    # (older figure code) has its figures built on demand
+    version = artifacts.current_version()
+    if version is None or version == _state['version']:
+        return
+    frames = read_only(artifacts.load_frames(version))
+    tables = artifacts.load_tables(version, precompute.TABLES_VERSION)
+    precompute.seed(frames, tables)
+    rendered = artifacts.load_figures(version, figures.FIGURES_VERSION)
+    if rendered is not None:
+        figures.warm(version, rendered)
+    with _lock:
+        _state.update(version=version, frames=frames)
+
+
+def first_load():
+    # nothing published yet: build it, or wait for the process building it
+    if artifacts.current_version() is None and config.refresh_in_server:
+        with artifacts.publisher(blocking=True):
+            if artifacts.current_version() is None:
+                update_feeds()
+    pick_up()
+    if _state['frames'] is None:
+        raise RuntimeError('no data version published in {}'.format(artifacts.current_path()))
+
+
+def refresh():
+    try:
+        if config.refresh_in_server:
+            with artifacts.publisher() as publishing:
+                if publishing:
+                    update_feeds()
+        pick_up()
+        _state['error'] = None
+    except Exception as e:
+        # keep serving the last good frames
+        _state['error'] = repr(e)
+        print('datacache: refresh failed, serving version {}: {!r}'.format(_state['version'], e),
+              file=sys.stderr)
+    finally:
+        with _lock:
+            _schedule.checked(latest_date(_state['frames']))
+            _state.update(checked=time.time(), refreshing=False)
+
+
+def latest_date(frames):
+    if frames is None or len(frames[0]) == 0:
+        return None
+    return frames[0]['date'].max().date()
+
+
+def current():
+    """
+    (data version, frames) to serve now. Treat the frames as read only
+    """
+    with _lock:
+        if _state['frames'] is None:
+            # nothing to serve yet, every caller waits for the first frames
+            first_load()
+        # a new schedule is due straight away, so the first frames are followed by a
+        # refresh. A version another process published is picked up on the next call
+        due = _schedule.due() or artifacts.current_version() != _state['version']
+        if not _state['refreshing'] and due:
+            _state['refreshing'] = True
+            threading.Thread(target=refresh, daemon=True).start()
+        return (_state['version'], _state['frames'])
+
+
+def version():
+    return _state['version']
+
+
+def status():
+    with _lock:
+        return dict({k: _state[k] for k in ['version', 'checked', 'refreshing', 'error']},
+                    next_check=_schedule.next_check)
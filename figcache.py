@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Figure cache shared by all the sessions of a server process
+#
+# A chart only depends on the function drawing it, the options picked on the
+# page and the processed data, so its figure json is kept under
+# (chart name, options, data version) and the chart is only built on a miss.
+# Entries are dropped least recently used once their json adds up to more
+# than config.figure_cache_mb. A new data version simply stops hitting the
+# old entries, which age out the same way.
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import plotly.io as pio
+import config
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_size = 0
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def normalise(value):
+    # hashable, insertion order independent form of the chart options
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), normalise(v)) for (k, v) in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalise(v) for v in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def make_key(name, options, version):
+    return (name, normalise(options), version)
+
+
+def lookup(key):
+    with _lock:
+        js = _entries.get(key)
+        if js is None:
+            _stats['misses'] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats['hits'] += 1
+        return js
+
+
+def entry_size(js):
+    return sum(len(j) for j in js) if isinstance(js, list) else len(js)
+
+
+def insert(key, js):
+    global _size
+    limit = config.figure_cache_mb * 1024 * 1024
+    with _lock:
+        if key in _entries:
+            _size -= entry_size(_entries.pop(key))
+        _entries[key] = js
+        _size += entry_size(js)
+        while _size > limit and len(_entries) > 1:
+            (_, old) = _entries.popitem(last=False)
+            _size -= entry_size(old)
+            _stats['evictions'] += 1
+
+
+def figure(version, name, options, build):
+    """
+    The figure of chart name with options on data version, built by build()
+    on a miss. build may also return a list of figures, a list comes back.
+    Each call returns figures of its own, callers can update them.
+    Without a version (data of unknown origin) nothing is cached
+    """
+    if version is None:
+        return build()
+
+    key = make_key(name, options, version)
+    js = lookup(key)
+    if js is None:
+        figs = build()
+        if isinstance(figs, (list, tuple)):
+            js = [f.to_json() for f in figs]
+        else:
+            js = figs.to_json()
+        insert(key, js)
+    if isinstance(js, list):
+        return [pio.from_json(j) for j in js]
+    return pio.from_json(js)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, entries=len(_entries), mb=round(_size / 1024 / 1024, 2))
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
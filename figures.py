@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# The dashboard figures, as main.py lays them out
+#
+# Each section of the page is a list of jobs (chart name, options, build):
+# the name and options key the figure in figcache, build draws it from the
+# processed frames. main.py renders the jobs of what the visitor picked;
+# render_all builds the jobs of every radio button combination in a process
+# pool when precompute.py publishes a data version, and the server processes
+# warm figcache with them, so the first visitor of a new data version doesn't
+# pay for the charts.
+
+import threading
+import multiprocessing
+import concurrent.futures
+import compare
+import chart
+import config
+import figcache
+import precompute
+
+# bump whenever a change alters the figure json (chart.py, the jobs below, the
+# chart settings in config.py), so the figures saved with a version are rebuilt
+FIGURES_VERSION = 1
+
+_lock = threading.Lock()
+_warm = set()
+_frames = None
+
+
+def render(version, jobs):
+    return [figcache.figure(version, name, options, build) for (name, options, build) in jobs]
+
+
+def headline_jobs(frames):
+    (df, overall_state_df, overall_ag_df, sag_df, milestone_df) = frames
+
+    def delta():
+        actual_max_date = df['date'].max().date()
+        heatmap_df = compare.get_latest(overall_state_df, actual_max_date).query('age_group == "16_or_above"')
+        return chart.heatmap_delta_data_dynamic(heatmap_df, "16+ population", "", "Jurisdictions",
+                                                headline_only=True)
+
+    return [('coverage_heatmap', {'headline_only': True},
+             lambda: chart.coverage_heatmap(sag_df, overall_state_df, c='dose1_pct', headline_only=True)),
+            ('heatmap_delta_data_dynamic', {'headline_only': True}, delta)]
+
+
+def option_frame(frames, opt_ag, opt_aj, opt_as):
+    # rows behind the main charts for the picked age group, jurisdiction and
+    # grouping, made once per frames so the charts' own preparation (see
+    # chart.dose_frame) is shared by every chart of those options
+    return compare.cached(frames[1], ('option_frame', opt_ag, opt_aj, opt_as),
+                          lambda: compare.read_only(select_rows(frames, opt_ag, opt_aj, opt_as)))
+
+
+def select_rows(frames, opt_ag, opt_aj, opt_as):
+    (df, overall_state_df, overall_ag_df, sag_df, milestone_df) = frames
+    extra_query = ''
+    if opt_as == "Jurisdictions":
+        plotly_df = overall_state_df
+        if opt_ag == "16+ (eligible)":
+            extra_query= 'age_group == "16_or_above"'
+        elif opt_ag == "12+":
+            extra_query= 'age_group == "12_or_above"'
+        if opt_ag != '16+ (eligible)' and opt_ag != '12+':
+            plotly_df = sag_df.query('age_group == @opt_ag')
+    elif opt_as == "Age Groups":
+        plotly_df = overall_ag_df
+        if opt_ag == "16+ (eligible)":
+            extra_query = 'age_group != "12-15"'
+        if opt_aj != "AUS":
+            plotly_df = sag_df.query('state == @opt_aj')
+
+    if extra_query != '':
+        plotly_df = plotly_df.query(extra_query)
+    return plotly_df
+
+
+def option_jobs(frames, opt_aa, opt_ag, opt_aj, opt_as, opt_autoscale, opt_ac):
+    """
+    Jobs of the main charts for the picked options, in the order they are shown
+    """
+    px_settings={'label_value':'',
+                 'facet':'',
+                 'facet_col_wrap':4,
+                 'range_y':None,
+            }
+    px_settings['y'] = [i[0] for i in config.analysis_options[opt_aa]]
+    px_settings['label_value'] = config.analysis_options[opt_aa][0][1]
+    if opt_as in ["Jurisdictions", "Age Groups"]:
+        px_settings['facet'] = px_settings['color'] = 'state' if opt_as == "Jurisdictions" else 'age_group'
+        px_settings['facet_col_wrap'] = 9
+
+    # one frame for all the charts of the options, only made when one gets built
+    def plotly_df():
+        return option_frame(frames, opt_ag, opt_aj, opt_as)
+
+    sel = {'opt_aa': opt_aa, 'opt_ag': opt_ag, 'opt_aj': opt_aj, 'opt_as': opt_as,
+           'opt_autoscale': opt_autoscale, 'opt_ac': opt_ac}
+    jobs = []
+    if opt_ac == "group":
+        if opt_aa == 'Dose 1 vs 2 Proportion':
+            setting = config.vac_volprop_facet_info
+            px_settings['y'] = [i[0] for i in setting]
+            px_settings['label_value'] = setting[0][1]
+
+        chart_fn = chart.exp_facet_chart if opt_aa == 'Growth Rate vs Coverage' else chart.facet_chart
+        jobs.append((chart_fn.__name__, [sel, px_settings],
+                     lambda: chart_fn(plotly_df(), opt_aa, **px_settings)))
+    elif opt_ac == "measure":
+        for px_info in config.analysis_options[opt_aa]:
+            (px_settings['y'], px_settings['y_label'], px_settings['graph_title']) = px_info
+            if opt_aa in ['Dose administered *est*', 'Dose administered (proportion) *est*']:
+                px_settings['opt_autoscale'] = opt_autoscale
+                px_settings['opt_aa'] = opt_aa
+                chart_fn=chart.volume_chart
+            elif opt_aa in ['Dose 1 vs 2 Proportion']:
+                chart_fn=chart.dose1v2_prop_chart
+            else:
+                px_settings['opt_aa'] = opt_aa
+                px_settings['opt_autoscale'] = opt_autoscale
+                chart_fn=chart.line_chart
+            # the settings as they are for this chart, the loop keeps changing px_settings
+            settings = dict(px_settings)
+            jobs.append((chart_fn.__name__, [sel, settings],
+                         lambda chart_fn=chart_fn, settings=settings: chart_fn(plotly_df(), **settings)))
+        if opt_aa == "Coverage":
+            jobs.append(('heatmap_delta_data_dynamic', sel,
+                         lambda: chart.heatmap_delta_data_dynamic(plotly_df(), opt_ag, opt_aj, opt_as)))
+
+    return jobs
+
+
+def heatmap_jobs(frames, date):
+    """
+    Jobs of the coverage, delta and gap heatmaps of date, read off the heatmap cube
+    """
+    (df, overall_state_df, overall_ag_df, sag_df, milestone_df) = frames
+    chosen = {'date': date}
+
+    def tables():
+        cube = chart.heatmap_cube(sag_df, overall_state_df)
+        return (cube, compare.get_latest(sag_df, date), compare.get_latest(overall_state_df, date))
+
+    def coverage():
+        (cube, heatmap_sag_df, heatmap_overall_state_df) = tables()
+        return chart.coverage_heatmap(heatmap_sag_df, heatmap_overall_state_df, cube=cube, date=date)
+
+    def delta():
+        (cube, _, heatmap_overall_state_df) = tables()
+        heatmap_df = heatmap_overall_state_df.query('age_group == "16_or_above"')
+        return chart.heatmap_delta_data_dynamic(heatmap_df, "16+ population", "", "Jurisdictions",
+                                                cube=cube, date=date)
+
+    def gap(col):
+        (cube, heatmap_sag_df, heatmap_overall_state_df) = tables()
+        return chart.gap_heatmap_data(heatmap_sag_df, heatmap_overall_state_df, col=col, cube=cube, date=date)
+
+    return [('coverage_heatmap', chosen, coverage),
+            ('heatmap_delta_data_dynamic', chosen, delta),
+            ('gap_heatmap_data', dict(chosen, col='dose1_pct'), lambda: gap('dose1_pct')),
+            ('gap_heatmap_data', dict(chosen, col='dose2_pct'), lambda: gap('dose2_pct'))]
+
+
+def milestone_jobs(frames):
+    milestone_df = frames[4]
+    return [('vaccine_milestone_chart', {'dose': 'dose 1'},
+             lambda: chart.vaccine_milestone_chart(milestone_df.query('dose == "dose 1"'))),
+            ('vaccine_milestone_chart', {'dose': 'dose 2'},
+             lambda: chart.vaccine_milestone_chart(milestone_df.query('dose == "dose 2"'))),
+            ('vaccine_milestone_chart', {'dose': 'all'},
+             lambda: chart.vaccine_milestone_chart(milestone_df.copy()))]
+
+
+def option_combos(frames):
+    # every combination of the main chart radio buttons main.py lets through
+    overall_ag_df = frames[2]
+    list_age_group = list(sorted(overall_ag_df['age_group'].unique()))
+    for opt_aa in config.analysis_options:
+        for opt_ag in ['16+ (eligible)'] + ['12+'] + list_age_group:
+            if opt_ag != "16+ (eligible)" and opt_ag != '12+':
+                list_aj = ['AUS']
+            else:
+                list_aj = config.states_rank
+            for opt_aj in list_aj:
+                group_options=config.grouping_options
+                if opt_aj != "AUS":
+                    group_options=config.age_group_only
+                elif opt_ag != "16+ (eligible)" and opt_ag != '12+':
+                    group_options=['Jurisdictions']
+                for opt_as in group_options:
+                    for opt_autoscale in ['on', 'off']:
+                        for opt_ac in config.chart_options:
+                            yield (opt_aa, opt_ag, opt_aj, opt_as, opt_autoscale, opt_ac)
+
+
+def page_jobs(frames, combo):
+    # combo None: the sections that don't depend on the radio buttons
+    if combo is not None:
+        return option_jobs(frames, *combo)
+    latest = frames[0]['date'].max().date()
+    return headline_jobs(frames) + heatmap_jobs(frames, latest) + milestone_jobs(frames)
+
+
+def init_worker(frames, tables):
+    global _frames
+    _frames = frames
+    precompute.seed(frames, tables)
+
+
+def build_jobs(combos):
+    # in a pool worker: the figure json of the jobs of combos
+    out = []
+    for combo in combos:
+        for (name, options, build) in page_jobs(_frames, combo):
+            figs = build()
+            if isinstance(figs, (list, tuple)):
+                js = [f.to_json() for f in figs]
+            else:
+                js = figs.to_json()
+            out.append((name, figcache.normalise(options), js))
+    return out
+
+
+def render_all(frames, tables=None):
+    """
+    (name, options, figure json) of every figure the page can show for frames,
+    the default options first. Built by config.prerender_workers processes,
+    seeded with the precompute.py tables of the frames when given
+    """
+    combos = [None] + list(option_combos(frames))
+    chunks = [combos[i:i + config.prerender_chunk] for i in range(0, len(combos), config.prerender_chunk)]
+    # the publisher may be a thread of the server, a plain fork could copy
+    # locks other threads hold (figcache, store, logging) into the workers
+    context = multiprocessing.get_context('forkserver')
+    with concurrent.futures.ProcessPoolExecutor(config.prerender_workers, mp_context=context,
+                                                initializer=init_worker, initargs=(frames, tables)) as pool:
+        results = list(pool.map(build_jobs, chunks))
+    return [job for out in results for job in out]
+
+
+def warm(version, rendered):
+    # fill figcache with the render_all figures of version, once per version
+    with _lock:
+        if version in _warm:
+            return
+        # the default options come first, insert them last so the LRU keeps them longest
+        for (name, options, js) in reversed(rendered):
+            figcache.insert(figcache.make_key(name, options, version), js)
+        _warm.add(version)
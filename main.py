@@ -10,6 +10,8 @@ import compare
 import data
 import chart
 import config
+import figures
+import datacache
 
 import plotly.express as px
 
@@ -40,7 +42,10 @@ st.markdown(f""" <style>
     </style> """, unsafe_allow_html=True)
 
 def main():
-    (df, overall_state_df, overall_ag_df, sag_df, milestone_df) = data.processing_data()
+    # the last good frames, refreshed in the background. Figures are cached
+    # across sessions per data version, see datacache.py and figcache.py
+    (version, frames) = datacache.current()
+    (df, overall_state_df, overall_ag_df, sag_df, milestone_df) = frames
     list_states = config.states_rank
     list_age_group = list(sorted(overall_ag_df['age_group'].unique()))
     latest_date = df['date'].max().date().strftime('%d %b %Y')
@@ -48,7 +53,7 @@ def main():
     latest_date = latest_date_published_dt.strftime('%d %b %Y')
 
     col1, col2, col3, col4 = st.columns(4)
-    figs = chart.coverage_heatmap(sag_df, overall_state_df, c='dose1_pct', headline_only=True)
+    (figs, delta_fig) = figures.render(version, figures.headline_jobs(frames))
     with col1:
         st.markdown('#### It is a race!')
         st.markdown('##### ausvacrace.info')
@@ -64,11 +69,7 @@ def main():
         st.plotly_chart(figs[1], use_container_width=True,\
                         config={'displayModeBar':False, 'staticPlot':True})
     with col4:
-        actual_max_date = df['date'].max().date()
-        heatmap_df = overall_state_df.query('age_group == "16_or_above" & date == @actual_max_date')
-        fig = chart.heatmap_delta_data_dynamic(heatmap_df, "16+ population", "", "Jurisdictions",
-                                                headline_only=True)
-
+        fig = delta_fig
         fig.update_layout(height=120)
         fig.update_layout(title=dict(font=dict(size=15)))
         st.plotly_chart(fig, use_container_width=True,\
@@ -76,23 +77,10 @@ def main():
 
 
     ############ MAIN CHARTS ####################
-    px_settings={'label_value':'',
-                 'facet':'',
-                 'facet_col_wrap':4,
-                 'range_y':None,
-            }
-    figs =[]
-
     col1, col2, col3, col4, col5, col6 = st.columns(6)
-    extra_query = ''
     with col1:
         opt_aa=st.radio('Show me charts of COVID-19 vaccination', list(config.analysis_options.keys()))
 
-        px_settings['y'] = [i[0] for i in config.analysis_options[opt_aa]]
-        px_settings['label_value'] = config.analysis_options[opt_aa][0][1]
-        if opt_aa == "Coverage":
-            px_settings['range_y'] = None
-
     with col2:
         opt_ag=st.radio('of people aged', ['16+ (eligible)'] + ['12+'] + list_age_group)
 
@@ -110,27 +98,6 @@ def main():
             group_options=['Jurisdictions']
 
         opt_as=st.radio('across', group_options)
-
-        if opt_as == "Jurisdictions":
-            plotly_df = overall_state_df
-            if opt_ag == "16+ (eligible)":
-                extra_query= 'age_group == "16_or_above"'
-            elif opt_ag == "12+":
-                extra_query= 'age_group == "12_or_above"'
-
-            px_settings['facet'] = px_settings['color'] = 'state'
-            px_settings['facet_col_wrap'] = 9
-            if opt_ag != '16+ (eligible)' and opt_ag != '12+':
-                plotly_df = sag_df.query('age_group == @opt_ag')
-        elif opt_as == "Age Groups":
-            plotly_df = overall_ag_df
-            if opt_ag == "16+ (eligible)":
-                extra_query = 'age_group != "12-15"'
-
-            if opt_aj != "AUS":
-                plotly_df = sag_df.query('state == @opt_aj')
-            px_settings['facet'] = px_settings['color'] = 'age_group'
-            px_settings['facet_col_wrap'] = 9
     with col5:
         opt_autoscale = st.radio('Graph y-axis auto-scale?', ['on', 'off'])
     with col6:
@@ -142,38 +109,9 @@ def main():
         #     options=['group']
         opt_ac=st.radio('with each graph is a', options, format_func=lambda x: select_options.get(x))
 
-        if extra_query != '':
-            plotly_df = plotly_df.query(extra_query)
-
-        if opt_ac == "group":
-            if opt_aa == 'Dose 1 vs 2 Proportion':
-                setting = config.vac_volprop_facet_info
-                px_settings['y'] = [i[0] for i in setting]
-                px_settings['label_value'] = setting[0][1]
-
-            if opt_aa == 'Growth Rate vs Coverage':
-                fig=chart.exp_facet_chart(plotly_df, opt_aa, **px_settings)
-                figs.append(fig)
-            else:
-                fig=chart.facet_chart(plotly_df, opt_aa, **px_settings)
-                figs.append(fig)
-        elif opt_ac == "measure":
-            for px_info in config.analysis_options[opt_aa]:
-                (px_settings['y'], px_settings['y_label'], px_settings['graph_title']) = px_info
-                if opt_aa in ['Dose administered *est*', 'Dose administered (proportion) *est*']:
-                    px_settings['opt_autoscale'] = opt_autoscale
-                    px_settings['opt_aa'] = opt_aa
-                    fig=chart.volume_chart(plotly_df, **px_settings)
-                elif opt_aa in ['Dose 1 vs 2 Proportion']:
-                    fig=chart.dose1v2_prop_chart(plotly_df, **px_settings)
-                else:
-                    px_settings['opt_aa'] = opt_aa
-                    px_settings['opt_autoscale'] = opt_autoscale
-                    fig=chart.line_chart(plotly_df, **px_settings)
-                figs.append(fig)
-            if opt_aa == "Coverage":
-                fig3 = chart.heatmap_delta_data_dynamic(plotly_df, opt_ag, opt_aj, opt_as)
-                figs.append(fig3)
+        # the charts of the picked options, see figures.option_jobs
+        figs = figures.render(version, figures.option_jobs(frames, opt_aa, opt_ag, opt_aj, opt_as,
+                                                           opt_autoscale, opt_ac))
 
     if len(figs) > 1:
         for col, fig, i in zip(st.columns(len(figs)), figs, range(0, len(figs))):
@@ -183,7 +121,7 @@ def main():
                     p_config={'displayModeBar':False, 'staticPlot': True}
                 st.plotly_chart(fig, use_container_width=True, config=p_config)
     else:
-        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar':False} )
+        st.plotly_chart(figs[0], use_container_width=True, config={'displayModeBar':False} )
     ############ MAIN CHARTS ####################
 
     ############ HEATMAP CHARTS ##################
@@ -204,11 +142,9 @@ def main():
         actual_chosen_date_dt = chosen_date_dt - datetime.timedelta(days=1)
         chosen_date = chosen_date_dt.strftime('%d %b %Y')
 
-    heatmap_sag_df = sag_df.query('date == @actual_chosen_date_dt')
-    heatmap_overall_state_df = overall_state_df.query('date == @actual_chosen_date_dt')
-    fig1, fig2 = chart.coverage_heatmap(heatmap_sag_df, heatmap_overall_state_df)
-    heatmap_df = overall_state_df.query('age_group == "16_or_above" & date == @actual_chosen_date_dt')
-    fig3 = chart.heatmap_delta_data_dynamic(heatmap_df, "16+ population", "", "Jurisdictions")
+    # the tables of the chosen date are a slice of the heatmap cube
+    (cov_figs, fig3, gap1, gap2) = figures.render(version, figures.heatmap_jobs(frames, actual_chosen_date_dt))
+    (fig1, fig2) = cov_figs
     for (col, fig) in zip(st.columns(3), [fig1, fig2, fig3]):
         with col:
             st.plotly_chart(fig, use_container_width=True,\
@@ -216,15 +152,13 @@ def main():
 
     st.markdown('#### *Coverage gap (% point) to the best jurisdiction per age group, using reports published on {}*'.format(chosen_date_str))
     st.write(' ')
-    fig1 = chart.gap_heatmap_data(heatmap_sag_df, heatmap_overall_state_df, col='dose1_pct')
-    fig2 = chart.gap_heatmap_data(heatmap_sag_df, heatmap_overall_state_df, col='dose2_pct')
     # fig2 = chart.gap_heatmap_data(heatmap_sag_df,col='dose2_pct')
     col1, col2, _ = st.columns(3)
     with col1:
-        st.plotly_chart(fig1, use_container_width=True,\
+        st.plotly_chart(gap1, use_container_width=True,\
                         config={'displayModeBar':False, 'staticPlot':True})
     with col2:
-        st.plotly_chart(fig2, use_container_width=True,\
+        st.plotly_chart(gap2, use_container_width=True,\
                         config={'displayModeBar':False, 'staticPlot':True})
     ########### DAILY VAC CHARTS ####################
     # st.markdown('### *Daily vaccination status*')
@@ -250,35 +184,16 @@ def main():
     user=compare.User()
     st.markdown("#### *Estimated dates to hit vaccine milestones*")
     opt_eta=st.radio('', ['16+'] + ['12+'])
-    eta_src = overall_state_df.query('age_group == "16_or_above"')
-    if opt_eta == "12+":
-        eta_src = overall_state_df.query('age_group == "12_or_above"')
+    # worked out once per data version, by precompute.py when it builds the artifacts
+    eta_1st, eta_2nd = data.eta_tables(overall_state_df, '12_or_above' if opt_eta == "12+" else '16_or_above')
     col1, col2, col3 = st.columns(3)
     with col1:
         st.markdown('#### *1st dose*')
-        res_df=pd.DataFrame()
-        for t in [70, 80, 90, 95]:
-            temp_0=eta_src.groupby('state').apply(data.predict_target_date_1stdose, t=t).reset_index().rename(columns= {0: "est_date"})
-            temp_0['target'] = 'target-' + str(t)
-            res_df = pd.concat([res_df, temp_0])
-
-        final=pd.pivot(res_df, index='state', columns=['target'], values='est_date').reset_index()
-        final['state']=pd.Categorical(final['state'], config.states_rank_heatmap)
-        final=final.sort_values('state')
-        st.table(final.assign(hack='').set_index('hack'))
+        st.table(eta_1st.assign(hack='').set_index('hack'))
 
     with col2:
         st.markdown('#### *2nd dose*')
-        res_df=pd.DataFrame()
-        for t in [70, 80, 90, 95]:
-            temp_0=eta_src.groupby('state').apply(data.predict_target_date, t=t).reset_index().rename(columns= {0: "est_date"})
-            temp_0['target'] = 'target-' + str(t)
-            res_df = pd.concat([res_df, temp_0])
-
-        final=pd.pivot(res_df, index='state', columns=['target'], values='est_date').reset_index()
-        final['state']=pd.Categorical(final['state'], config.states_rank_heatmap)
-        final=final.sort_values('state')
-        st.table(final.assign(hack='').set_index('hack'))
+        st.table(eta_2nd.assign(hack='').set_index('hack'))
 
     with col3:
         st.markdown('#### Our methods of estimating vaccine milestone dates:')
@@ -291,16 +206,10 @@ def main():
         st.markdown('7. No approach is perfect -- our estimate is dynamic and will be updated daily. However, by giving an interval of dates, we hope that viewers will appreciate the difficulty in predicting the future. We do expect the interval between two dates will shrink as we get closer to the target.')
 
     st.markdown("#### Vaccination milestone for 16+")
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        fig = chart.vaccine_milestone_chart(milestone_df.query('dose == "dose 1"'))
-        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar':False})
-    with col2:
-        fig = chart.vaccine_milestone_chart(milestone_df.query('dose == "dose 2"'))
-        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar':False})
-    with col3:
-        fig = chart.vaccine_milestone_chart(milestone_df)
-        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar':False})
+    milestone_figs = figures.render(version, figures.milestone_jobs(frames))
+    for (col, fig) in zip(st.columns(3), milestone_figs):
+        with col:
+            st.plotly_chart(fig, use_container_width=True, config={'displayModeBar':False})
 
     ############# ETA CHARTS ###############
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# The images daily-graph.py posts, rendered and put together in memory
+#
+# A post is a few figures put together into one png. The figures of all the
+# posts go to a pool of config.image_workers processes as json and come back
+# as png bytes. Each worker keeps its kaleido renderer (a headless chromium)
+# for all the figures it gets, started once when the worker comes up. The
+# panels are then put together with Pillow, only the posts are written out.
+#
+# Each post is keyed by a hash of the figure specs it is made from. The
+# manifest in config.image_dir records the hash of every image written and how
+# long it took, so a post whose figures didn't change since is skipped.
+
+import io
+import os
+import json
+import time
+import hashlib
+import concurrent.futures
+import plotly.io as pio
+import plotly.graph_objects as go
+from PIL import Image
+import config
+import store
+
+MANIFEST = 'manifest.json'
+
+
+def init_worker():
+    # start the renderer of this worker before the figures come in
+    pio.to_image(go.Figure(), format='png')
+
+
+def to_png(js):
+    # (png bytes, seconds it took) of a figure json
+    start = time.perf_counter()
+    png = pio.to_image(pio.from_json(js), format='png')
+    return (png, time.perf_counter() - start)
+
+
+def render_pngs(specs):
+    """
+    to_png of the figure jsons in specs, in order, rendered in parallel
+    """
+    # rendering is cpu bound, more renderers than cpus only adds browsers to start
+    workers = min(config.image_workers, os.cpu_count() or 1, len(specs))
+    if workers <= 1:
+        # nothing to share out, this process's own renderer does them all
+        return [to_png(js) for js in specs]
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+        return list(pool.map(to_png, specs))
+
+
+def compose(pngs, stacked, offset=1):
+    """
+    One png of the pngs, top to bottom when stacked, side by side otherwise,
+    offset pixels apart on a white background and aligned top left, as wand's
+    smush(stacked, offset) does with opaque images
+    """
+    images = [Image.open(io.BytesIO(b)) for b in pngs]
+    if stacked:
+        size = (max(i.width for i in images), sum(i.height for i in images) + offset * (len(images) - 1))
+    else:
+        size = (sum(i.width for i in images) + offset * (len(images) - 1), max(i.height for i in images))
+    canvas = Image.new('RGBA', size, 'white')
+    pos = 0
+    for i in images:
+        canvas.paste(i, (0, pos) if stacked else (pos, 0))
+        pos += (i.height if stacked else i.width) + offset
+
+    out = io.BytesIO()
+    canvas.save(out, format='PNG')
+    return out.getvalue()
+
+
+def spec_hash(specs, stacked):
+    # hash of what a post is made from. Plotly express gives the parts of a
+    # trace mode in no fixed order ('lines+markers' or 'markers+lines'), they
+    # are sorted so the same figure always hashes the same
+    h = hashlib.sha256(json.dumps(stacked).encode())
+    for js in specs:
+        spec = json.loads(js)
+        for trace in spec.get('data', []):
+            if isinstance(trace.get('mode'), str):
+                trace['mode'] = '+'.join(sorted(trace['mode'].split('+')))
+        h.update(json.dumps(spec, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def manifest_path():
+    return os.path.join(config.image_dir, MANIFEST)
+
+
+def read_manifest():
+    try:
+        with open(manifest_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_posts(posts):
+    """
+    Write out the posts whose figures changed since they were last written,
+    rendering the figures of all of them in one go.
+    posts: list of (file name in config.image_dir, figures, stacked).
+    Returns the names of the posts written
+    """
+    os.makedirs(config.image_dir, exist_ok=True)
+    manifest = read_manifest()
+    todo = []
+    for (name, figs, stacked) in posts:
+        specs = [f.to_json() for f in figs]
+        key = spec_hash(specs, stacked)
+        entry = manifest.get(name)
+        if entry is not None and entry['hash'] == key and os.path.exists(os.path.join(config.image_dir, name)):
+            continue
+        todo.append((name, specs, stacked, key))
+
+    rendered = iter(render_pngs([js for (_, specs, _, _) in todo for js in specs]))
+    for (name, specs, stacked, key) in todo:
+        panels = [next(rendered) for _ in specs]
+        start = time.perf_counter()
+        png = compose([p for (p, _) in panels], stacked)
+        seconds = sum(s for (_, s) in panels) + time.perf_counter() - start
+        store.write_file(os.path.join(config.image_dir, name), png)
+        # recorded as each post is written, a failed run keeps what it got done
+        manifest[name] = {'hash': key, 'render_seconds': round(seconds, 3), 'bytes': len(png),
+                          'written': time.strftime('%Y-%m-%d %H:%M:%S')}
+        store.write_file(manifest_path(), json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return [name for (name, _, _, _) in todo]
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Batch build of everything the dashboard serves
+#
+# Runs the pipeline on the feeds (ingest, age grouping, processing, milestones)
+# and works out the tables the page reads off the frames: the ETA tables, the
+# heatmap cube and the compare rankings, then renders every figure of the page.
+# Frames, tables and figures are saved as one version in config.artifact_dir
+# (see artifacts.py) and published to the server processes, with the time each
+# stage took printed on the way:
+#
+#     python precompute.py [--offline] [--rebuild]
+#
+# Run on a schedule with config.refresh_in_server off, the servers never fetch
+# or build anything and only map the versions published here (see datacache.py).
+# seed() puts the saved tables back in the caches of the loaded frames, as if
+# they had been worked out in that process, and the figures go straight into
+# figcache.
+
+import sys
+import time
+import argparse
+import pandas as pd
+import artifacts
+import store
+import data
+import chart
+import compare
+import figures
+
+# bump whenever a change alters the tables below (data.predict_target_dates,
+# chart.heatmap_cube, compare.rank_columns / sort_eta ...), so the tables saved
+# with a version are rebuilt even though its frames stay
+TABLES_VERSION = 1
+
+# (stage, position of the frame it belongs to, compare.cached key, build from the frames)
+TABLES = [('eta tables', 1, ('eta', ag), lambda f, ag=ag: data.eta_tables(f[1], ag))
+          for ag in ['16_or_above', '12_or_above']] + \
+         [('heatmap cube', 3, 'heatmap_cube', lambda f: chart.heatmap_cube(f[3], f[1])),
+          ('compare rankings', 1, 'ranked', lambda f: compare.latest_ranked(f[1])),
+          ('compare rankings', 2, 'ranked', lambda f: compare.latest_ranked(f[2])),
+          ('compare rankings', 3, ('within', 'state'), lambda f: compare.latest_records_within(f[3], 'state')),
+          ('compare rankings', 3, ('within', 'age_group'),
+           lambda f: compare.latest_records_within(f[3], 'age_group'))]
+
+
+def build_tables(frames, step=data.run_step):
+    tables = dict()
+    for (stage, pos, key, build) in TABLES:
+        try:
+            value = step(stage, build, frames)
+        except Exception as e:
+            # the version is still published, the table is worked out on demand if ever
+            print('precompute: no {} table {!r}: {!r}'.format(stage, key, e), file=sys.stderr)
+            continue
+        if key == 'heatmap_cube':
+            # the cube remembers the frame it was built from, seed puts it back
+            value = {k: v for (k, v) in value.items() if k != 'overall_state_df'}
+        tables[(pos, key)] = value
+    return tables
+
+
+def seed(frames, tables):
+    # hand the tables of build_tables to the caches of frames
+    for ((pos, key), value) in (tables or {}).items():
+        if key == 'heatmap_cube':
+            value = dict(value, overall_state_df=frames[1])
+        compare.cached(frames[pos], key, lambda: value)
+
+
+def build(step=data.run_step, rebuild=False):
+    """
+    Build, save and publish the frames and tables of the feeds as they are in
+    the local store. What the artifact directory already has of the version is
+    reused unless rebuild. Call with the artifacts publisher lock held.
+    Returns (version, frames), version None when the feeds changed meanwhile
+    """
+    (version, frames) = data.versioned_frames(step, rebuild)
+    if version is None:
+        return (None, frames)
+    tables = None
+    if rebuild or not artifacts.has_tables(version, TABLES_VERSION):
+        tables = build_tables(frames, step)
+        step('save', artifacts.save_tables, version, TABLES_VERSION, tables)
+    if rebuild or not artifacts.has_figures(version, figures.FIGURES_VERSION):
+        if tables is None:
+            tables = artifacts.load_tables(version, TABLES_VERSION)
+        rendered = step('figures', figures.render_all, frames, tables)
+        step('save', artifacts.save_figures, version, figures.FIGURES_VERSION, rendered)
+    step('publish', artifacts.publish, version)
+    return (version, frames)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and publish the dashboard artifacts')
+    parser.add_argument('--offline', action='store_true', help="use the feeds in the local store as they are")
+    parser.add_argument('--rebuild', action='store_true', help='rebuild a version the artifact directory has')
+    args = parser.parse_args(argv)
+
+    timings = dict()
+    def timed(name, fn, *fn_args):
+        start = time.perf_counter()
+        try:
+            return fn(*fn_args)
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+    with artifacts.publisher(blocking=True):
+        if not args.offline:
+            timed('fetch', store.refresh)
+        (version, frames) = build(timed, args.rebuild)
+
+    print(pd.DataFrame(list(timings.items()), columns=['stage', 'seconds']).set_index('stage'))
+    print(data.memory_report(frames))
+    if version is None:
+        print('the feeds changed during the build, nothing published', file=sys.stderr)
+        return 1
+    print('published', version)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
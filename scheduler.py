@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# When to look for new data
+#
+# The feeds get one new DATE_AS_AT a day, the data of date d being published
+# on d + 1 somewhere around config.publish_window (local time in
+# config.publish_tz). Once the data of yesterday is in there is nothing to look
+# for until tomorrow's window, and before today's window opens the snapshot we
+# have is trusted as well. From the window opening until the day's data shows
+# up, the checks back off from config.poll_min_seconds to
+# config.poll_max_seconds, late publications included.
+# The clock is pluggable, so a day of checks can be played offline.
+
+import time
+import datetime
+import pandas as pd
+import config
+
+
+class Schedule:
+    def __init__(self, clock=time.time):
+        # clock: returns the time now, in epoch seconds
+        self.clock = clock
+        self.next_check = 0.0
+        self.misses = 0
+
+    def due(self):
+        return self.clock() >= self.next_check
+
+    def window(self, local):
+        # opening and closing time of the publication window of local's day,
+        # as wall clock times so a daylight saving change doesn't move them
+        return [pd.Timestamp('{} {}'.format(local.date(), t), tz=config.publish_tz)
+                for t in config.publish_window]
+
+    def checked(self, latest):
+        """
+        Plan the next check after one that left us with data up to latest (a date,
+        None when we have nothing)
+        """
+        now = self.clock()
+        local = pd.Timestamp(now, unit='s', tz='UTC').tz_convert(config.publish_tz)
+        (open_at, close_at) = self.window(local)
+        expected = local.date() - datetime.timedelta(days=1)
+
+        if latest is not None and latest >= expected:
+            # today's data is in, next look is tomorrow's window
+            self.misses = 0
+            self.next_check = (open_at + pd.DateOffset(days=1)).timestamp()
+        elif latest is not None and local < open_at:
+            self.misses = 0
+            self.next_check = open_at.timestamp()
+        else:
+            # waiting for today's data: back off between checks, past the window
+            # it's late and the slowest pace will do
+            wait = min(config.poll_max_seconds, config.poll_min_seconds * 2 ** self.misses)
+            if local >= close_at:
+                wait = config.poll_max_seconds
+            self.misses += 1
+            self.next_check = now + wait
+        return self.next_check
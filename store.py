@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# Local snapshot store for the AIR csv feeds
+#
+# Each feed in config.feeds is mirrored into config.store_dir as a plain csv
+# (so pd.read_csv on it gives the same frame as reading the url), next to a
+# small json file remembering how much of the remote file we have seen.
+# The feeds only ever grow by one DATE_AS_AT per day, so a refresh asks the
+# server for the bytes after what we already have and appends the rows that
+# are newer than the last stored date. The request is also conditional on the
+# ETag / Last-Modified of the previous fetch, so on most refreshes the server
+# just answers 304 and nothing is downloaded or rebuilt.
+
+import os
+import re
+import csv
+import json
+import shutil
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+import pandas as pd
+import config
+
+DATE_COL = 'DATE_AS_AT'
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+_lock = threading.Lock()
+
+
+def csv_path(name):
+    return os.path.join(config.store_dir, name + '.csv')
+
+
+def meta_path(name):
+    return os.path.join(config.store_dir, name + '.json')
+
+
+def read_meta(name):
+    try:
+        with open(meta_path(name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_meta(name, meta):
+    write_file(meta_path(name), json.dumps(meta).encode())
+
+
+def write_file(path, content, base=None):
+    # write next to the target and rename, readers never see a half written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        if base is not None:
+            with open(base, 'rb') as b:
+                shutil.copyfileobj(b, f)
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def fetch(url, start=None, meta=None):
+    """
+    Returns (http status, body, validators)
+    start asks for the bytes from that offset only; meta holds the ETag and
+    Last-Modified seen last time for this url, so an unchanged file answers
+    304 with no body
+    """
+    req = urllib.request.Request(url)
+    if start is not None:
+        req.add_header('Range', 'bytes={}-'.format(start))
+    if meta is not None and meta.get('url') == url:
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        with urllib.request.urlopen(req, timeout=config.fetch_timeout) as r:
+            return r.status, r.read(), validators(r.headers)
+    except urllib.error.HTTPError as e:
+        # 304: not modified since last time
+        # 416: nothing from start on, the file got shorter
+        if e.code in (304, 416):
+            return e.code, b'', validators(e.headers)
+        raise
+
+
+def validators(headers):
+    if headers is None:
+        return {}
+    return {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+
+
+def split_lines(body):
+    # complete lines only, a trailing partial line is picked up next time
+    end = body.rfind(b'\n') + 1
+    return [l + b'\n' for l in body[:end].split(b'\n')[:-1]], end
+
+
+def row_date(line, date_idx):
+    try:
+        date = next(csv.reader([line.decode('utf-8')]))[date_idx]
+    except (StopIteration, IndexError, UnicodeDecodeError, csv.Error):
+        return None
+    return date if DATE_RE.match(date) else None
+
+
+def new_rows(lines, date_idx, last_date):
+    rows = []
+    for line in lines:
+        d = row_date(line, date_idx)
+        if d is not None and (last_date is None or d > last_date):
+            rows.append((d, line))
+    return rows
+
+
+def bootstrap(name):
+    # first run, no choice but to download the whole history
+    url = config.feeds[name]
+    status, body, valid = fetch(url)
+    # size and last line as upstream has them, the ranged requests are made against those
+    (size, last_line) = (len(body), body[body.rfind(b'\n', 0, len(body) - 1) + 1:])
+    if not body.endswith(b'\n'):
+        body += b'\n'
+    lines, _ = split_lines(body)
+    date_idx = next(csv.reader([lines[0].decode('utf-8')])).index(DATE_COL)
+    dates = [d for (d, _) in new_rows(lines[1:], date_idx, None)]
+
+    os.makedirs(config.store_dir, exist_ok=True)
+    write_file(csv_path(name), body)
+    meta = {'url': url, 'size': size, 'last_line': last_line.decode('utf-8'),
+            'last_date': max(dates) if dates else None, 'date_idx': date_idx}
+    meta.update(valid)
+    write_meta(name, meta)
+    return len(lines) - 1
+
+
+def refresh_feed(name):
+    """
+    Bring the local copy of a feed up to date, returns the number of rows appended
+    """
+    meta = read_meta(name)
+    if meta is None or not os.path.exists(csv_path(name)):
+        return bootstrap(name)
+
+    url = config.feeds[name]
+    # overlap the request with the last line we have, to check the remote file
+    # is still the one we mirrored
+    overlap = meta['last_line'].encode('utf-8')
+    start = meta['size'] - len(overlap)
+    status, body, valid = fetch(url, start, meta)
+
+    if status == 304:
+        # nothing changed upstream, nothing to download or rebuild
+        return 0
+    if status == 206 and body.startswith(overlap):
+        # what follows our last line is new, a date may go on from the last chunk
+        lines, consumed = split_lines(body[len(overlap):])
+        size = meta['size'] + consumed
+        rows = new_rows(lines, meta['date_idx'], None)
+        if lines:
+            meta['last_line'] = lines[-1].decode('utf-8')
+    else:
+        # the server ignored the range, or the file was rewritten upstream
+        # (a 416: the range starts inside our last line, so the file got shorter).
+        # Use the whole body, the date check only keeps the rows after what we have
+        if status in (206, 416):
+            status, body, valid = fetch(url)
+        lines, size = split_lines(body)
+        rows = new_rows(lines[1:], meta['date_idx'], meta['last_date'])
+        # the header when that's all there is
+        meta['last_line'] = lines[-1].decode('utf-8') if lines else ''
+
+    meta['size'] = size
+    meta['url'] = url
+    meta.update(valid)
+    if rows:
+        write_file(csv_path(name), b''.join(l for (_, l) in rows), base=csv_path(name))
+        meta['last_date'] = max([d for (d, _) in rows] + [meta['last_date'] or ''])
+    write_meta(name, meta)
+
+    return len(rows)
+
+
+def refresh():
+    with _lock:
+        return {name: refresh_feed(name) for name in config.feeds}
+
+
+def refresh_in_background():
+    # skip if another refresh is still running
+    if not _lock.acquire(blocking=False):
+        return None
+
+    def run():
+        try:
+            for name in config.feeds:
+                try:
+                    refresh_feed(name)
+                except (OSError, ValueError):
+                    # network trouble, keep serving what we have
+                    pass
+        finally:
+            _lock.release()
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+
+
+def ensure_feed(name):
+    # the network is only touched when there is no local copy yet
+    if not os.path.exists(csv_path(name)):
+        with _lock:
+            if not os.path.exists(csv_path(name)):
+                bootstrap(name)
+    return csv_path(name)
+
+
+def read_header(name):
+    with open(ensure_feed(name), newline='') as f:
+        return next(csv.reader([f.readline()]))
+
+
+def read_feed(name, **kwargs):
+    return pd.read_csv(ensure_feed(name), **kwargs)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# store.fetch / refresh_feed against a stand-in feed server on localhost that
+# answers like the AIR one: ETag and Last-Modified on every response, 304 to a
+# matching conditional request, 206 to a Range, 416 to a Range past the end
+
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import config
+import store
+
+HEADER = b'DATE_AS_AT,STATE,DOSE1\n'
+
+
+def day(date, n):
+    return '{},NSW,{}\n'.format(date, n).encode()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        feed = self.server.feed
+        body = feed['body']
+        headers = {'Last-Modified': formatdate(feed['mtime'], usegmt=True)}
+        if feed['etag']:
+            headers['ETag'] = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+
+        rng = self.headers.get('Range')
+        if feed['ignore_range']:
+            rng = None
+        if feed['etag'] and self.headers.get('If-None-Match') == headers['ETag']:
+            (status, out) = (304, b'')
+        elif not feed['etag'] and self.headers.get('If-Modified-Since') == headers['Last-Modified']:
+            (status, out) = (304, b'')
+        elif rng is not None:
+            start = int(rng[len('bytes='):-1])
+            if start >= len(body):
+                (status, out) = (416, b'')
+                headers['Content-Range'] = 'bytes */{}'.format(len(body))
+            else:
+                (status, out) = (206, body[start:])
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))
+        else:
+            (status, out) = (200, body)
+        feed['seen'].append(status)
+
+        self.send_response(status)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def feed(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    server.feed = {'body': HEADER + day('2021-08-01', 10) + day('2021-08-02', 20),
+                   'mtime': 1627776000, 'etag': True, 'ignore_range': False, 'seen': []}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(config, 'store_dir', str(tmp_path))
+    monkeypatch.setattr(config, 'feeds', {'f': 'http://127.0.0.1:{}/f.csv'.format(server.server_port)})
+    yield server.feed
+    server.shutdown()
+    server.server_close()
+
+
+def publish(feed, body):
+    feed['body'] = body
+    feed['mtime'] += 86400
+
+
+def local(name='f'):
+    with open(store.csv_path(name), 'rb') as f:
+        return f.read()
+
+
+def test_unchanged_feed_answers_304(feed):
+    assert store.refresh_feed('f') == 2
+    assert store.refresh_feed('f') == 0
+    assert feed['seen'] == [200, 304]
+    assert local() == feed['body']
+
+
+def test_last_modified_alone_gives_304(feed):
+    feed['etag'] = False
+    store.refresh_feed('f')
+    assert store.refresh_feed('f') == 0
+    assert feed['seen'] == [200, 304]
+
+
+def test_new_rows_come_as_206(feed):
+    store.refresh_feed('f')
+    publish(feed, feed['body'] + day('2021-08-03', 30))
+    assert store.refresh_feed('f') == 1
+    assert feed['seen'] == [200, 206]
+    assert local() == feed['body']
+    assert store.read_meta('f')['size'] == len(feed['body'])
+
+
+def test_ignored_range_gets_200_and_keeps_new_rows_only(feed):
+    store.refresh_feed('f')
+    feed['ignore_range'] = True
+    publish(feed, feed['body'] + day('2021-08-03', 30))
+    assert store.refresh_feed('f') == 1
+    assert feed['seen'] == [200, 200]
+    assert local() == feed['body']
+
+
+def test_shorter_file_416_refetches_whole(feed):
+    store.refresh_feed('f')
+    # rewritten upstream: the history is dropped, one new day is added
+    publish(feed, HEADER + day('2021-08-03', 30))
+    assert store.refresh_feed('f') == 1
+    assert feed['seen'] == [200, 416, 200]
+    assert local() == HEADER + day('2021-08-01', 10) + day('2021-08-02', 20) + day('2021-08-03', 30)
+    assert store.read_meta('f')['size'] == len(feed['body'])
+
+    # and the next refresh is a plain conditional one again
+    assert store.refresh_feed('f') == 0
+    assert feed['seen'][-1] == 304